@@ -0,0 +1,294 @@
+'''Benchmarks for hey, run offline against stub docker/docker-compose/kubectl/gcloud/ssh binaries (stub.sh)
+
+    python benchmarks/run.py                       run every scenario and compare with the baselines
+    python benchmarks/run.py logs-merge pushtogke  run only some scenarios
+    python benchmarks/run.py --save                record the results as the new baselines
+
+Every run starts a fresh interpreter in a throwaway project, so wall time includes startup. Reported
+per scenario: median wall time, peak RSS of the hey process, how many stub subprocesses it started and,
+for throughput scenarios such as logs-merge, the rate the scenario measured itself. A scenario regresses
+when its wall time or RSS grows (or its rate drops) by more than --threshold against the baseline, when
+it starts more subprocesses than before, or when its rate is below the scenario's minimum; the script
+then exits 1. Baselines are machine specific, so baselines.json is not checked in.
+'''
+import sys, os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+HEY_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'hey_helpers')
+HEY = os.path.join(HEY_DIR, 'hey_helpers.py')
+STUB_TOOLS = ['docker', 'docker-compose', 'kubectl', 'gcloud', 'ssh']
+CLIENT_SECRET = 'client_secret_712322130843-pi61a3cagb4ic94d5pep77n5tpv4dmf1.apps.googleusercontent.com.json'
+
+# Timing noise on a quiet machine; below this a slower wall time never counts as a regression
+WALL_SLACK = 0.02
+
+HEY_YML = '''compose_files: [dc.yml]
+readiness_probes: [pg_isready]
+readiness_timeout: 10
+use_daemon: false
+'''
+
+DC_YML = '''services:
+  postgres:
+    image: postgres:15
+    environment:
+      POSTGRES_DB: habitdb
+      POSTGRES_USER: habitdb
+'''
+
+# Code scenarios run after this, with `hey` imported as a module from a config root
+PREAMBLE = '''import sys
+sys.path.insert(0, {!r})
+sys.argv = ['hey']
+import hey_helpers as hey
+hey._go_to_working_dir()
+'''
+
+COMMAND_MATCH = '''import io, contextlib
+for i in range(10000):
+    hey.command(lambda: None, command_name='synthetic-{:05d}'.format(i))
+with contextlib.redirect_stdout(io.StringIO()):
+    for i in range(300):
+        hey._command_match('synthetic-{:05d}'.format(i * 31))
+        hey._command_match('synthetic-0{}'.format(i % 10), short_commands=True)
+    # A miss ranks every name by edit distance, so a few are plenty
+    for i in range(3):
+        hey._command_match('synthetc-{:05d}'.format(i))
+'''
+
+COMPOSE = '''hey.CONFIG['compose_files'] = ['big.yml']
+for _ in range(20):
+    hey._get_compose_files()
+assert len(hey.COMPOSE_FILE['services']) == 1500
+'''
+
+TAG_PARSE = '''assert hey._kubegetlatesttagarray('gcr.io/habitdb/habitdb-www') == [1, 200, 0]
+output = hey._run(['gcloud', 'container', 'images', 'list-tags', 'x'], capture_stdout=True).stdout.decode()
+for _ in range(50):
+    hey._parse_tag_array(output)
+'''
+
+# 300k lines from 8 services with a little clock skew, pushed through the merger and filter the way
+# `hey logs --follow --grep ... --level ...` does. Generating the lines isn't part of the rate.
+LOGS_MERGE = '''import os
+from time import perf_counter
+levels = ['DEBUG', 'INFO', 'INFO', 'WARNING', 'ERROR']
+lines = []
+for i in range(300000):
+    source = i % 8
+    micros = i * 40 + (source * 7919) % 300
+    lines.append(('service{}'.format(source), '2026-10-17T17:{:02d}:{:02d}.{:06d}Z {} GET /api/items/{} took {}ms'.format(
+        micros // 60000000 % 60, micros // 1000000 % 60, micros % 1000000, levels[i % 5], i, i % 997)))
+log_filter, merger = hey._LogFilter(['items/[0-9]*7 ', 'took 9'], 'INFO'), hey._LogMerger(0.25)
+started = perf_counter()
+shown = 0
+for i, (source, line) in enumerate(lines):
+    now = i * 1e-5
+    merger.push(source, line, now)
+    if i % 1000 == 999:
+        shown += sum(1 for _, _, message in merger.pop_ready(now) if log_filter(message))
+shown += sum(1 for _, _, message in merger.pop_ready() if log_filter(message))
+assert shown > 0
+with open(os.path.join(os.environ['HEY_BENCH_STATE'], 'rate'), 'w') as stream:
+    stream.write(str(len(lines) / (perf_counter() - started)))
+'''
+
+
+def _big_compose_file(services=1500):
+    lines = ['services:']
+    for i in range(services):
+        lines += ['  service{}:'.format(i),
+                  '    image: gcr.io/habitdb/service{}:v1.0.{}'.format(i, i),
+                  '    environment:']
+        lines += ['      VAR_{}: "value {} of service {}"'.format(v, v, i) for v in range(10)]
+        lines += ['    ports:', '      - "{}:8000"'.format(10000 + i),
+                  '    volumes:', '      - ./service{}:/app'.format(i),
+                  '    depends_on: [postgres]']
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as stream:
+        stream.write(text)
+
+
+def _make_project(root):
+    _write(os.path.join(root, 'hey.yml'), HEY_YML)
+    _write(os.path.join(root, 'dc.yml'), DC_YML)
+    _write(os.path.join(root, 'big.yml'), _big_compose_file())
+    _write(os.path.join(root, 'app', CLIENT_SECRET), '{}')
+    _write(os.path.join(root, 'Dockerfile'), 'FROM python:3\n')
+    _write(os.path.join(root, 'kanbanflow_sync', 'Dockerfile'), 'FROM python:3\n')
+    # Not a pg_dump archive, so restore takes the tarball path
+    _write(os.path.join(root, 'data.tar'), 'data directory tarball\n')
+
+
+def _make_stubs(bin_dir):
+    os.makedirs(bin_dir)
+    stub = os.path.join(bin_dir, 'stub.sh')
+    shutil.copy(os.path.join(BENCH_DIR, 'stub.sh'), stub)
+    os.chmod(stub, 0o755)
+    for tool in STUB_TOOLS:
+        os.symlink(stub, os.path.join(bin_dir, tool))
+
+
+# name -> {argv | code, env (stub settings), fresh (drop the project's .hey before each run),
+#          min_rate (items/s the scenario reports in $HEY_BENCH_STATE/rate must reach)}
+SCENARIOS = {
+    'dispatch': {'argv': ['alias']},
+    'dispatch-miss': {'argv': ['no-such-command']},
+    'command-match-10k': {'code': COMMAND_MATCH},
+    'compose-large-cold': {'code': COMPOSE, 'fresh': True},
+    'compose-large-cached': {'code': COMPOSE},
+    'restore-polling': {'argv': ['restore', 'data.tar'], 'env': {'HEY_STUB_PG_DELAY': '0.5'}},
+    'tag-parse': {'code': TAG_PARSE, 'env': {'HEY_STUB_TAGS': '20000'}},
+    'pushtogke': {'argv': ['pushtogke'], 'env': {'HEY_STUB_LATENCY': '0.05'}, 'fresh': True},
+    'logs-merge': {'code': LOGS_MERGE, 'min_rate': 100000},
+}
+
+
+def _run_once(scenario, project, state_dir, env):
+    '''(wall seconds, peak RSS in KiB, stub subprocesses, reported rate or None) of one run of a scenario'''
+    for name in ('calls', 'pg_started', 'rate'):
+        if os.path.exists(os.path.join(state_dir, name)):
+            os.remove(os.path.join(state_dir, name))
+    if scenario.get('fresh'):
+        shutil.rmtree(os.path.join(project, '.hey'), ignore_errors=True)
+    if 'argv' in scenario:
+        command = [sys.executable, HEY] + scenario['argv']
+    else:
+        command = [sys.executable, '-c', PREAMBLE.format(HEY_DIR) + scenario['code']]
+    env = dict(env, **scenario.get('env', {}))
+    with open(os.path.join(state_dir, 'output'), 'wb') as output:
+        started = perf_counter()
+        proc = subprocess.Popen(command, cwd=project, env=env, stdin=subprocess.DEVNULL,
+                                stdout=output, stderr=subprocess.STDOUT)
+        # wait4 rather than wait: it hands back the child's own resource usage
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        with open(os.path.join(state_dir, 'output'), 'r', errors='replace') as stream:
+            print(stream.read()[-2000:])
+        raise RuntimeError('`{}` exited with {}'.format(' '.join(scenario.get('argv', ['-c', '...'])), proc.returncode))
+    try:
+        with open(os.path.join(state_dir, 'calls'), 'r') as stream:
+            calls = len(stream.readlines())
+    except OSError:
+        calls = 0
+    try:
+        with open(os.path.join(state_dir, 'rate'), 'r') as stream:
+            rate = float(stream.read())
+    except (OSError, ValueError):
+        rate = None
+    return wall, usage.ru_maxrss, calls, rate
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def _measure(names, repeat):
+    results = {}
+    work = tempfile.mkdtemp(prefix='hey-bench-')
+    try:
+        project, state_dir, bin_dir = (os.path.join(work, d) for d in ('project', 'state', 'bin'))
+        _make_project(project)
+        _make_stubs(bin_dir)
+        os.makedirs(state_dir)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   HEY_BENCH_STATE=state_dir, HEY_CACHE_DIR=os.path.join(work, 'cache'))
+        for name in names:
+            scenario = SCENARIOS[name]
+            # Untimed, so .pyc files, the config root cache and the page cache are warm
+            _run_once(scenario, project, state_dir, env)
+            runs = [_run_once(scenario, project, state_dir, env) for _ in range(repeat)]
+            results[name] = {'wall': round(_median([r[0] for r in runs]), 4),
+                             'rss_kb': max(r[1] for r in runs),
+                             'subprocesses': max(r[2] for r in runs)}
+            if runs[0][3] is not None:
+                results[name]['rate'] = round(_median([r[3] for r in runs]))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def _regressions(name, result, baseline, threshold):
+    found = []
+    if result.get('rate') is not None and result['rate'] < SCENARIOS[name].get('min_rate', 0):
+        found.append('rate below {}/s'.format(SCENARIOS[name]['min_rate']))
+    if not baseline:
+        return found
+    if result.get('rate') is not None and baseline.get('rate') and result['rate'] < baseline['rate'] * (1 - threshold):
+        found.append('rate')
+    if result['wall'] > baseline['wall'] * (1 + threshold) + WALL_SLACK:
+        found.append('wall')
+    if result['rss_kb'] > baseline['rss_kb'] * (1 + threshold):
+        found.append('rss')
+    if result['subprocesses'] > baseline['subprocesses']:
+        found.append('subprocesses')
+    return found
+
+
+def _change(value, base):
+    return '{:+.0f}%'.format(100.0 * (value - base) / base) if base else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hey against stub binaries')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all of {})'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per scenario (default 5)')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed growth over the baseline (default 0.25)')
+    parser.add_argument('--baselines', default=os.path.join(BENCH_DIR, 'baselines.json'))
+    parser.add_argument('--save', action='store_true', help='store these results as the baselines')
+    options = parser.parse_args()
+    if not sys.platform.startswith('linux'):
+        parser.error('the benchmarks use Linux-only rusage and shell stubs')
+    unknown = [name for name in options.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenario(s) {}'.format(', '.join(unknown)))
+
+    try:
+        with open(options.baselines, 'r') as stream:
+            baselines = json.load(stream)
+    except (OSError, ValueError):
+        baselines = {}
+    results = _measure(options.scenarios or list(SCENARIOS), options.repeat)
+
+    print('{:<22} {:>9} {:>7} {:>9} {:>7} {:>7} {:>10}  {}'.format(
+        'scenario', 'wall', 'change', 'peak RSS', 'change', 'procs', 'rate', 'status'))
+    failed = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        regressed = _regressions(name, result, baseline, options.threshold)
+        if regressed:
+            failed.append(name)
+        status = 'REGRESSED ({})'.format(', '.join(regressed)) if regressed else 'ok' if baseline else 'no baseline'
+        rate = '{:,.0f}/s'.format(result['rate']) if result.get('rate') is not None else '-'
+        print('{:<22} {:>8.3f}s {:>7} {:>7.1f}MB {:>7} {:>7} {:>10}  {}'.format(
+            name, result['wall'], _change(result['wall'], baseline['wall']) if baseline else '-',
+            result['rss_kb'] / 1024.0, _change(result['rss_kb'], baseline['rss_kb']) if baseline else '-',
+            result['subprocesses'], rate, status))
+
+    if options.save:
+        baselines.update(results)
+        with open(options.baselines, 'w') as stream:
+            json.dump(baselines, stream, indent=2, sort_keys=True)
+        print('\nSaved baselines to {}'.format(options.baselines))
+    elif failed:
+        print('\n{} regressed by more than {:.0f}% (or started more subprocesses, or fell below its minimum rate)'.format(
+            ', '.join(failed), options.threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
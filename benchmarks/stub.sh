@@ -0,0 +1,30 @@
+#!/bin/sh
+# Offline stand-in for docker, docker-compose, kubectl, gcloud and ssh; benchmarks/run.py links each
+# tool name to this file. Every call is logged to $HEY_BENCH_STATE/calls and takes $HEY_STUB_LATENCY
+# seconds; `list-tags` prints $HEY_STUB_TAGS tags and pg_isready passes $HEY_STUB_PG_DELAY seconds
+# after `up -d postgres`.
+tool=${0##*/}
+# One line per call, however many lines the arguments span
+echo "$tool" >> "$HEY_BENCH_STATE/calls"
+sleep "${HEY_STUB_LATENCY:-0.01}"
+
+case "$tool $*" in
+    "kubectl config current-context"*)
+        echo gke_habitdb_us-central1-f_cluster-habitdb ;;
+    "kubectl get pods"*)
+        echo '{"items": []}' ;;
+    "gcloud container images list-tags"*)
+        awk -v n="${HEY_STUB_TAGS:-3}" 'BEGIN {
+            for (i = n; i > 0; i--) printf "%sv1.%d.%d", (i < n ? ";" : ""), int(i / 100), i % 100
+            print ";latest" }' ;;
+    "docker image inspect"*)
+        exit 1 ;;
+    "docker-compose "*"up -d postgres"*)
+        date +%s.%N > "$HEY_BENCH_STATE/pg_started" ;;
+    "docker-compose "*" pg_isready "*)
+        [ -f "$HEY_BENCH_STATE/pg_started" ] || exit 1
+        awk -v started="$(cat "$HEY_BENCH_STATE/pg_started")" -v now="$(date +%s.%N)" \
+            -v delay="${HEY_STUB_PG_DELAY:-0.5}" 'BEGIN { exit !(now - started >= delay) }' ;;
+    "ssh "*)
+        echo "habitdb_backup.tar" ;;
+esac
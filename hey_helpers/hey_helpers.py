@@ -1,11 +1,132 @@
 import sys, os
-import subprocess
-import functools
-import getpass
 from io import open
-from yaml import load
-from yaml import Loader
-from time import sleep
+from time import sleep, perf_counter
+
+_MODULE_START = perf_counter()
+
+# Set to a dict by `hey --profile-startup`
+_PROFILE = None
+
+
+_IMPORTED = {}
+
+def _lazy_import(name):
+    module = _IMPORTED.get(name)
+    if module is None:
+        fresh = name not in sys.modules
+        start = perf_counter()
+        # Always go through __import__: another thread may be half way through importing it
+        __import__(name)
+        module = _IMPORTED[name] = sys.modules[name]
+        if _PROFILE is not None and fresh:
+            _PROFILE['imports'].append((name, perf_counter() - start))
+            _PROFILE['import_total'] += perf_counter() - start
+    return module
+
+
+class _LazyModule:
+    '''Stand-in for a module that is only imported the first time one of its attributes is used'''
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(_lazy_import(self._name), attr)
+
+
+subprocess = _LazyModule('subprocess')
+getpass = _LazyModule('getpass')
+json = _LazyModule('json')
+yaml = _LazyModule('yaml')
+socket = _LazyModule('socket')
+select = _LazyModule('select')
+tempfile = _LazyModule('tempfile')
+threading = _LazyModule('threading')
+random = _LazyModule('random')
+shlex = _LazyModule('shlex')
+hashlib = _LazyModule('hashlib')
+asyncio = _LazyModule('asyncio')
+collections = _LazyModule('collections')
+struct = _LazyModule('struct')
+
+
+def _profile_start():
+    if _PROFILE is None:
+        return None
+    return perf_counter(), _PROFILE['import_total']
+
+
+def _profile_phase(name, start):
+    '''Record time since _profile_start(), minus any lazy imports (those are reported on their own)'''
+    if _PROFILE is not None and start is not None:
+        started_at, imports_before = start
+        elapsed = perf_counter() - started_at - (_PROFILE['import_total'] - imports_before)
+        _PROFILE['phases'][name] = _PROFILE['phases'].get(name, 0) + elapsed
+
+
+# Timing records (see _record_timing), appended to the timing log in one write when hey exits
+_TIMINGS = []
+_TIMING_STATE = {'registered': False}
+
+def _timing_name(command):
+    '''The program and its first positional argument, e.g. "docker-compose exec" for
+    ['docker-compose', '-f', 'a.yml', 'exec', ...]'''
+    if isinstance(command, str):
+        command = command.split()
+    if not command:
+        return '?'
+    args = iter(command[1:])
+    for arg in args:
+        if arg in ('-f', '--file', '-p', '--project-name', '-c', '-n', '--namespace'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return '{} {}'.format(os.path.basename(command[0]), arg)
+    return os.path.basename(command[0])
+
+def _record_timing(kind, name, started, returncode, output_bytes=0, first_output=None):
+    '''Queue a timing record. `started` and `first_output` are perf_counter() values.'''
+    if CONFIG.get('timing_log', True) is False:
+        return
+    now = perf_counter()
+    _TIMINGS.append({'at': round(_lazy_import('time').time(), 3), 'kind': kind, 'name': name,
+                     'wall': round(now - started, 4), 'exit': returncode, 'bytes': output_bytes,
+                     'ttfo': None if first_output is None else round(first_output - started, 4),
+                     '_first': first_output})
+    if not _TIMING_STATE['registered']:
+        _TIMING_STATE['registered'] = True
+        _lazy_import('atexit').register(_flush_timings)
+
+def _timing_log_path():
+    return os.path.join(_cache_dir(), 'timings.jsonl')
+
+def _flush_timings():
+    '''Append the queued records to .hey/timings.jsonl, first moving it to timings.jsonl.1 once it is
+    over timing_log_max_kb (default 1024)'''
+    records = list(_TIMINGS)
+    del _TIMINGS[:]
+    if not records or not WORKING_DIR or not any(os.path.exists(os.path.join(WORKING_DIR, f)) for f in CONFIG_FILENAMES):
+        return
+    path = _timing_log_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if (_stat_key(path) or [0, 0])[1] > CONFIG.get('timing_log_max_kb', 1024) * 1024:
+            os.replace(path, path + '.1')
+        with open(path, 'a') as stream:
+            stream.write(''.join(json.dumps({k: v for k, v in r.items() if not k.startswith('_')},
+                                            separators=(',', ':')) + '\n' for r in records))
+    except OSError:
+        pass
+
+
+def _yaml_load(stream, safe=True):
+    start = _profile_start()
+    if safe:
+        loader = getattr(yaml, 'CSafeLoader', None) or yaml.SafeLoader
+    else:
+        loader = yaml.Loader
+    loaded = yaml.load(stream, Loader=loader)
+    _profile_phase('yaml parse', start)
+    return loaded
+
 
 COMMANDS = {}
 
@@ -16,10 +137,21 @@ CONFIG = {
     'compose_files': ['docker-compose.DEV.yml']
 }
 COMPOSE_FILE = {}
+_COMPOSE_CACHE = {}
+_COMPOSE_CACHE_STATE = {'loaded_from_disk': False, 'dirty': False, 'merged_key': None}
+
+CONFIG_FILENAMES = ['hey.yml', 'hey.yaml']
+CONFIG_CACHE_MAX_ENTRIES = 256
+WORKING_DIR = None
+
+def command(_func=None, *, command_name=None, noninteractive=False, needs_config=True):
+    global all_commands
+    # Commands registered after the first lookup (plugins) need a fresh index
+    all_commands = None
 
-def command(_func=None, *, command_name=None, noninteractive=False):
     def decorator_command_noargs(func):
         command_name = func.__name__
+        func.needs_config = needs_config
         if noninteractive:
             NONINTERACTIVE[command_name] = func
         else:
@@ -29,16 +161,12 @@ def command(_func=None, *, command_name=None, noninteractive=False):
     def decorator_command(func, command_name, noninteractive):
         if not command_name:
             command_name = func.__name__
+        func.needs_config = needs_config
         if noninteractive:
             NONINTERACTIVE[command_name] = func
         else:
             COMMANDS[command_name] = func
-
-        @functools.wraps(func)
-        def wrapper_command(*args, **kwargs):
-            value = func(*args, **kwargs)
-            return value
-        return wrapper_command
+        return func
 
     if _func is None:
         return decorator_command_noargs
@@ -46,21 +174,93 @@ def command(_func=None, *, command_name=None, noninteractive=False):
         return decorator_command(_func, command_name, noninteractive)
 
 
+TASKS = {}
+
+def task(name, deps=(), up_to_date=None):
+    '''Register a step for _run_tasks(). `deps` run first; a task whose up_to_date() returns True is skipped'''
+    def decorator(func):
+        TASKS[name] = {'func': func, 'deps': list(deps), 'up_to_date': up_to_date}
+        return func
+    return decorator
+
+
 def _handle_err(cmd):
     if cmd.returncode != 0:
         msg = getattr(cmd, 'stderr', b'No error message')
-        if msg:
-            print("There was a problem:", msg.decode())
+        if msg and getattr(cmd, 'stderr_echoed', False):
+            # It was already shown as it happened; repeat the end of it where it can't be missed
+            lines = msg.splitlines(True)[-CONFIG.get('error_summary_lines', 10):]
+            print("There was a problem (exit code {}):".format(cmd.returncode), b''.join(lines).decode(errors='replace'))
+        elif msg:
+            print("There was a problem:", msg.decode(errors='replace'))
         sys.exit(1)
     return cmd
 
 
 def _get_config_file_here(filepath):
-    valid_filenames = ['hey.yml', 'hey.yaml']
-    filename = next((f for f in os.listdir(filepath) if f in valid_filenames), None)
+    filename = next((f for f in os.listdir(filepath) if f in CONFIG_FILENAMES), None)
     return filename
 
 
+def _cache_dir():
+    '''Per-project cache folder under the config root'''
+    return os.path.join(WORKING_DIR or os.path.realpath(os.curdir), CONFIG.get('cache_dir', '.hey'))
+
+
+def _compose_disk_cache_path():
+    # JSON rather than pickle: the file lives in the project tree, so loading it must not run code
+    return os.path.join(_cache_dir(), 'compose_cache.json')
+
+
+def _load_compose_disk_cache():
+    _COMPOSE_CACHE_STATE['loaded_from_disk'] = True
+    if not CONFIG.get('compose_disk_cache', True):
+        return
+    try:
+        entries = [(path, (tuple(key), model)) for path, (key, model) in _read_json(_compose_disk_cache_path(), {}).items()]
+    except (ValueError, TypeError, AttributeError):
+        return
+    for path, value in entries:
+        _COMPOSE_CACHE.setdefault(path, value)
+
+
+def _json_safe(model):
+    '''Whether a parsed compose file survives a JSON round trip unchanged (no dates, non-string keys...)'''
+    try:
+        return json.loads(json.dumps(model)) == model
+    except (TypeError, ValueError):
+        return False
+
+
+def _save_compose_disk_cache():
+    if not (_COMPOSE_CACHE_STATE['dirty'] and CONFIG.get('compose_disk_cache', True)):
+        return
+    _COMPOSE_CACHE_STATE['dirty'] = False
+    # Files that don't survive JSON are simply re-parsed next time
+    cached = {path: [list(key), model] for path, (key, model) in _COMPOSE_CACHE.items() if _json_safe(model)}
+    _write_json(_compose_disk_cache_path(), cached)
+
+
+def _load_compose_file(path):
+    '''Parsed compose file, re-parsed only when its mtime or size changes'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    if not _COMPOSE_CACHE_STATE['loaded_from_disk']:
+        _load_compose_disk_cache()
+    cached = _COMPOSE_CACHE.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(path, 'r') as stream:
+        loaded_compose_file = _yaml_load(stream) or {}
+    _COMPOSE_CACHE[path] = (key, loaded_compose_file)
+    _COMPOSE_CACHE_STATE['dirty'] = True
+    return loaded_compose_file
+
+
 def _get_compose_files():
     compose_files = CONFIG.get('compose_files', ['docker-compose.DEV.yml'])
     if type(compose_files) is not list:
@@ -69,44 +269,286 @@ def _get_compose_files():
         else:
             compose_files = [compose_files]
     current_dir = os.path.realpath(os.curdir)
-    for compose_file in compose_files:
-        with open(os.path.join(current_dir, compose_file), 'r') as stream:
-            loaded_compose_file = load(stream, Loader=Loader)
+    models = [(p, _load_compose_file(p)) for p in (os.path.join(current_dir, cf) for cf in compose_files)]
+    merged_key = [(p, _COMPOSE_CACHE[p][0]) for p, m in models if m is not None]
+    if merged_key != _COMPOSE_CACHE_STATE['merged_key']:
+        COMPOSE_FILE.clear()
+        for path, loaded_compose_file in models:
             if loaded_compose_file:
                 COMPOSE_FILE.update(loaded_compose_file)
+        _COMPOSE_CACHE_STATE['merged_key'] = merged_key
+    _save_compose_disk_cache()
     return compose_files
 
 
+def _compose_model():
+    '''The merged compose model for the current config, loaded through the compose cache'''
+    _get_compose_files()
+    return COMPOSE_FILE
+
+
+def _service_environment(service):
+    environment = _compose_model().get('services', {}).get(service, {}).get('environment') or {}
+    if isinstance(environment, dict):
+        return {k: '' if v is None else str(v) for k, v in environment.items()}
+    return {k.split('=', 1)[0]: k.split('=', 1)[1] for k in environment if '=' in k}
+
+
+def _user_cache_dir():
+    if os.environ.get('HEY_CACHE_DIR'):
+        return os.environ['HEY_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'hey_helper')
+
+
+def _atomic_write(path, write, mode='w'):
+    '''Write a file through a temp file and os.replace, so readers never see half of it. Returns False,
+    leaving nothing behind, when it can't be written (unwritable folder, data json can't encode...).'''
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), _lazy_import('_thread').get_ident())
+    try:
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        with open(tmp_path, mode) as stream:
+            write(stream)
+        os.replace(tmp_path, path)
+        return True
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def _write_json(path, data, **options):
+    return _atomic_write(path, lambda stream: json.dump(data, stream, **options))
+
+
+def _read_json(path, default):
+    try:
+        with open(path, 'r') as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return default
+
+
+def _config_cache_path():
+    return os.path.join(_user_cache_dir(), 'config_roots.json')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _find_config_root(start_dir):
+    '''Walk up from start_dir, returning (config dir, config filename, every dir looked at)'''
+    walked = []
+    current_dir = start_dir
+    while True:
+        walked.append(current_dir)
+        config_file = _get_config_file_here(current_dir)
+        if config_file:
+            return current_dir, config_file, walked
+        parent_dir = os.path.dirname(current_dir)
+        if parent_dir == current_dir:
+            return None, None, walked
+        current_dir = parent_dir
+
+
+def _read_config_cache():
+    return _read_json(_config_cache_path(), {})
+
+
+def _cached_config_root(start_dir):
+    '''A cache entry is only trusted if no directory on the walk (or the config file) has changed since'''
+    entry = _read_config_cache().get(start_dir)
+    if not entry:
+        return None
+    for path, mtime in entry['dirs']:
+        if _mtime(path) != mtime:
+            return None
+    if entry['root'] and _mtime(os.path.join(entry['root'], entry['config_file'])) != entry['config_mtime']:
+        return None
+    return entry
+
+
+def _write_config_cache(start_dir, entry):
+    cache = _read_config_cache()
+    cache.pop(start_dir, None)
+    cache[start_dir] = entry
+    while len(cache) > CONFIG_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    # Unwritable cache dir or a config that doesn't survive json; just skip caching
+    _write_json(_config_cache_path(), cache)
+
+
+def _resolve_config(start_dir):
+    start = _profile_start()
+    entry = _cached_config_root(start_dir)
+    if entry:
+        _profile_phase('config walk', start)
+        return entry
+
+    root, config_file, walked = _find_config_root(start_dir)
+    _profile_phase('config walk', start)
+    entry = {'root': root, 'config_file': config_file, 'config_mtime': None, 'config': {},
+             'dirs': [[d, _mtime(d)] for d in walked]}
+    if root:
+        config_path = os.path.join(root, config_file)
+        entry['config_mtime'] = _mtime(config_path)
+        with open(config_path, 'r') as stream:
+            entry['config'] = _yaml_load(stream, safe=False) or {}
+    _write_config_cache(start_dir, entry)
+    return entry
+
+
+# Held while the config is loaded, so batch items running side by side (hey run --parallel) load it once
+_CONFIG_LOCK = _lazy_import('_thread').allocate_lock()
+
 def _go_to_working_dir():
-    this_dir = os.path.dirname(os.path.realpath(__file__))
-    current_dir = os.path.realpath(os.curdir)
-    config_root = _get_config_file_here(current_dir)
-    while not config_root:
-        previous_dir = current_dir
-        current_dir = os.path.join(current_dir, os.path.pardir)
-        if os.path.realpath(previous_dir) == os.path.realpath(current_dir):
-            # Shockingly there isn't a better way to figure out if we're at root?
+    '''Find the config root (once per process), load its config and chdir there'''
+    global WORKING_DIR
+    if not WORKING_DIR:
+        with _CONFIG_LOCK:
+            if not WORKING_DIR:
+                entry = _resolve_config(os.path.realpath(os.curdir))
+                if entry['root']:
+                    print("wk_dir(config root): ", entry['root'])
+                    CONFIG.update(entry['config'])
+                    root = entry['root']
+                else:
+                    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir)
+                    print("wk_dir: ", root)
+                # Only now: other threads take a set WORKING_DIR to mean the config is loaded
+                WORKING_DIR = root
+    os.chdir(WORKING_DIR)
+    return WORKING_DIR
+
+def _binary_stream(stream):
+    return getattr(stream, 'buffer', None)
+
+async def _pump(reader, echo=None, ring=None, capture=None, tee=None, counts=None):
+    '''Copy a child's output as it arrives: to one of our own streams, a tee file, a ring buffer of
+    its last lines and/or a full capture. `counts` tallies bytes and when the first ones came.'''
+    partial = b''
+    while True:
+        data = await reader.read(1 << 16)
+        if not data:
+            break
+        if counts is not None:
+            counts['bytes'] += len(data)
+            counts['first'] = counts['first'] or perf_counter()
+        if echo is not None:
+            binary = _binary_stream(echo)
+            if binary is not None:
+                binary.write(data)
+                binary.flush()
+            else:
+                echo.write(data.decode(errors='replace'))
+        if tee is not None:
+            tee.write(data)
+        if capture is not None:
+            capture.append(data)
+        if ring is not None:
+            lines = (partial + data).split(b'\n')
+            # A line is only complete once its newline arrives; cap what can pile up without one
+            partial = lines.pop()[-(1 << 16):]
+            ring.extend(line + b'\n' for line in lines)
+    if ring is not None and partial:
+        ring.append(partial)
+
+async def _read_lines(reader):
+    '''A child's output line by line, however long the lines get (`async for` on a StreamReader gives up
+    past 64 KiB). The last line may lack its newline.'''
+    buffer = bytearray()
+    while True:
+        data = await reader.read(1 << 16)
+        if not data:
             break
-        config_root = _get_config_file_here(current_dir)
-    if config_root:
-        os.chdir(current_dir)
-        print("wk_dir(config root): ", current_dir)
-
-        with open(os.path.join(current_dir, config_root), 'r') as stream:
-            loaded_config = load(stream, Loader=Loader)
-            if loaded_config:
-                CONFIG.update(loaded_config)
-            # print(CONFIG)
-        return current_dir
-
-    wk_dir = os.path.join(this_dir, os.path.pardir)
-    os.chdir(wk_dir)
-    print("wk_dir: ", wk_dir)
-    return wk_dir
-
-_go_to_working_dir()
-
-def _docker_compose(command_array, compose_files=None, handle_errors=True):
+        start = len(buffer)
+        buffer += data
+        # Only the new data can hold a newline; whatever is left over from before has none
+        start = buffer.find(b'\n', start)
+        end = 0
+        while start >= 0:
+            yield bytes(buffer[end:start + 1])
+            end = start + 1
+            start = buffer.find(b'\n', end)
+        del buffer[:end]
+    if buffer:
+        yield bytes(buffer)
+
+async def _terminate(proc):
+    if proc.returncode is None:
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), 5)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+_TEE_COUNT = [0]
+
+def _tee_prefix(command):
+    '''Where to tee a child's output when `tee_dir` is set in hey.yml (or HEY_TEE_DIR)'''
+    tee_dir = os.environ.get('HEY_TEE_DIR') or CONFIG.get('tee_dir')
+    if not tee_dir:
+        return None
+    os.makedirs(tee_dir, exist_ok=True)
+    _TEE_COUNT[0] += 1
+    name = command.split()[0] if isinstance(command, str) else command[0]
+    return os.path.join(tee_dir, '{}-{}-{}-{}'.format(_lazy_import('time').strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                                                      _TEE_COUNT[0], os.path.basename(name)))
+
+async def _run_async(command, capture_stdout=False, echo_stderr=True, tee=None, shell=False, **kwargs):
+    '''Run a child, streaming its stderr live while keeping only its last lines (error_buffer_lines, default 200).
+    stdout stays on the terminal unless it is captured or teed. Cancelling terminates the child.'''
+    pipe = asyncio.subprocess.PIPE
+    stdout = pipe if capture_stdout or tee else None
+    started, counts = perf_counter(), {'bytes': 0, 'first': None}
+    if shell:
+        proc = await asyncio.create_subprocess_shell(command if isinstance(command, str) else ' '.join(command),
+                                                     stdout=stdout, stderr=pipe, **kwargs)
+    else:
+        proc = await asyncio.create_subprocess_exec(*command, stdout=stdout, stderr=pipe, **kwargs)
+    ring = collections.deque(maxlen=CONFIG.get('error_buffer_lines', 200))
+    captured = [] if capture_stdout else None
+    tee_files = [open('{}.{}.log'.format(tee, name), 'wb') for name in ('stdout', 'stderr')] if tee else [None, None]
+    pumps = [_pump(proc.stderr, sys.stderr if echo_stderr else None, ring, None, tee_files[1], counts)]
+    if stdout:
+        pumps.append(_pump(proc.stdout, None if capture_stdout else sys.stdout, None, captured, tee_files[0], counts))
+    returncode = -1
+    try:
+        await asyncio.gather(*pumps)
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        await _terminate(proc)
+        raise
+    finally:
+        for f in tee_files:
+            if f:
+                f.close()
+        # stdout that goes straight to the terminal isn't seen, so bytes and first output only cover the pipes
+        _record_timing('process', _timing_name(command), started, returncode, counts['bytes'], counts['first'])
+    result = subprocess.CompletedProcess(command, returncode, b''.join(captured) if capture_stdout else None, b''.join(ring))
+    result.stderr_echoed = echo_stderr
+    return result
+
+def _run(command, tee=None, **kwargs):
+    '''Run one child through the asyncio core from synchronous code (see _run_async)'''
+    sys.stdout.flush()
+    return asyncio.run(_run_async(command, tee=tee or _tee_prefix(command), **kwargs))
+
+def _run_many(commands, **kwargs):
+    '''Run several children at once; Ctrl-C terminates all of them'''
+    sys.stdout.flush()
+    async def run_all():
+        return await asyncio.gather(*[_run_async(c, tee=_tee_prefix(c), **kwargs) for c in commands])
+    return asyncio.run(run_all())
+
+def _compose_command(command_array, compose_files=None):
     if not compose_files:
         compose_files = _get_compose_files()
 
@@ -114,35 +556,568 @@ def _docker_compose(command_array, compose_files=None, handle_errors=True):
     for cf in compose_files:
         if os.path.isfile(cf):
             command += ['-f', cf]
-    command += command_array
-
-    print('Command: ', '`', ' '.join(command).strip(), '`', sep='')
+    return command + command_array
+
+def _docker_compose(command_array, compose_files=None, handle_errors=True, quiet=False):
+    command = _compose_command(command_array, compose_files)
+
+    client = None
+    if command_array[:1] and command_array[0] in DAEMON_OPS and CONFIG.get('use_daemon', True):
+        client = _daemon_connect()
+    if client:
+        if not quiet:
+            print('Command (daemon): ', '`', ' '.join(command).strip(), '`', sep='')
+        result = _daemon_run(client, command, capture_stdout=not handle_errors, echo_stderr=handle_errors)
+        return _handle_err(result) if handle_errors else result
+
+    if not quiet:
+        print('Command: ', '`', ' '.join(command).strip(), '`', sep='')
     if handle_errors:
-        return _handle_err(subprocess.run(command, stderr=subprocess.PIPE))
-    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-def _command_match(cmd, short_commands=False):
-    if cmd.isdigit() and int(cmd) < len(COMMANDS.keys()):
-        COMMANDS[list(COMMANDS.keys())[int(cmd)]]()
+        return _handle_err(_run(command))
+    return _run(command, capture_stdout=True, echo_stderr=False)
+
+# docker-compose subcommands that are sent to `hey daemon` when it is running
+DAEMON_OPS = ['exec', 'logs', 'up']
+
+def _daemon_socket_path():
+    path = os.path.join(_cache_dir(), 'daemon.sock')
+    if len(path) > 100:
+        # AF_UNIX paths are capped at ~108 bytes, so deep checkouts get a short name in a folder only we
+        # can write to; a shared temp dir would let another user squat the name and receive our environment
+        directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(_user_cache_dir(), 'sockets')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        digest = hashlib.sha1(path.encode()).hexdigest()[:16]
+        path = os.path.join(directory, 'hey-{}.sock'.format(digest))
+    return path
+
+def _daemon_peer_uid(sock, path):
+    '''uid of the process on the other end of a unix socket, or failing that the owner of the socket file'''
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+    return os.stat(path).st_uid
+
+def _daemon_connect(path=None):
+    '''A socket connected to a running `hey daemon`, or None when there isn't one (or it isn't ours)'''
+    path = path or _daemon_socket_path()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        # Requests carry our environment and terminal, so never hand them to another user's process
+        if _daemon_peer_uid(client, path) != os.getuid():
+            print('Ignoring {}: it belongs to another user'.format(path), file=sys.stderr)
+            client.close()
+            return None
+    except OSError:
+        client.close()
+        return None
+    return client
+
+def _daemon_send(sock, message, fds=()):
+    payload = (json.dumps(message) + '\n').encode()
+    sent = socket.send_fds(sock, [payload], list(fds)) if fds else 0
+    sock.sendall(payload[sent:])
+
+def _daemon_recv(sock, maxfds=0):
+    '''Read one newline-terminated JSON message, plus any file descriptors sent along with it'''
+    data, fds, _, _ = socket.recv_fds(sock, 1 << 16, maxfds) if maxfds else (sock.recv(1 << 16), [], 0, None)
+    while data and not data.endswith(b'\n'):
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode() or 'null'), list(fds)
+
+def _daemon_request(message, path=None):
+    client = _daemon_connect(path)
+    if not client:
+        return None
+    try:
+        _daemon_send(client, message)
+        return _daemon_recv(client)[0]
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
+
+async def _daemon_run_async(client, command, capture_stdout, echo_stderr):
+    stdout = tempfile.TemporaryFile() if capture_stdout else None
+    read_fd, write_fd = os.pipe()
+    try:
+        fds = [sys.stdin.fileno(), (stdout or sys.stdout).fileno(), write_fd]
+        _daemon_send(client, {'op': 'run', 'command': command, 'cwd': os.getcwd(), 'env': dict(os.environ),
+                              'tty': sys.stdin.isatty()}, fds)
+    except OSError as e:
+        os.close(read_fd)
+        client.close()
+        return {'error': str(e)}, None, b''
+    finally:
+        os.close(write_fd)
+
+    # The child's stderr comes back through the pipe, so it streams just like a local child's
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, 'rb'))
+    ring = collections.deque(maxlen=CONFIG.get('error_buffer_lines', 200))
+    try:
+        reply = loop.run_in_executor(None, lambda: _daemon_recv(client)[0] or {})
+        await _pump(reader, sys.stderr if echo_stderr else None, ring)
+        reply = await reply
+    except OSError as e:
+        reply = {'error': str(e)}
+    finally:
+        # Closing the connection (e.g. on Ctrl-C) makes the daemon terminate the child
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+        transport.close()
+    output = None
+    if stdout is not None:
+        stdout.seek(0)
+        output = stdout.read()
+        stdout.close()
+    return reply, output, b''.join(ring)
+
+def _daemon_run(client, command, capture_stdout=False, echo_stderr=True):
+    '''Have the daemon run `command` on this process's stdin/stdout; stderr is streamed back through a pipe'''
+    sys.stdout.flush()
+    started = perf_counter()
+    reply, stdout, stderr = asyncio.run(_daemon_run_async(client, command, capture_stdout, echo_stderr))
+    _record_timing('process', _timing_name(command) + ' (daemon)', started, reply.get('returncode', 1),
+                   len(stdout or b'') + len(stderr or b''))
+    if 'returncode' not in reply:
+        stderr += 'hey daemon failed: {}\n'.format(reply.get('error', 'no reply')).encode()
+    result = subprocess.CompletedProcess(command, reply.get('returncode', 1), stdout, stderr)
+    result.stderr_echoed = echo_stderr and 'returncode' in reply
+    return result
+
+def _docker_engine_socket():
+    host = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+    if not host.startswith('unix://') or not os.path.exists(host[len('unix://'):]):
+        return None
+    return host[len('unix://'):]
+
+class _DockerEngine:
+    '''Keep-alive HTTP connection to the container runtime's local socket'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        http_client = _lazy_import('http.client')
+        conn = http_client.HTTPConnection('localhost')
+        def connect():
+            conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.sock.connect(self.path)
+        conn.connect = connect
+        return conn
+
+    def get(self, url):
+        http_client = _lazy_import('http.client')
+        with self.lock:
+            for attempt in range(2):
+                if self.conn is None:
+                    self.conn = self._connect()
+                try:
+                    self.conn.request('GET', url)
+                    response = self.conn.getresponse()
+                    body = response.read()
+                    break
+                except (OSError, http_client.HTTPException) as e:
+                    # The runtime may have dropped an idle keep-alive connection; retry once on a fresh one
+                    self.conn.close()
+                    self.conn = None
+                    if attempt:
+                        raise OSError(str(e))
+        if response.status != 200:
+            raise OSError('docker engine: {} {}'.format(response.status, body[:200]))
+        return json.loads(body)
+
+def _compose_project_name(command, cwd, env):
+    re = _lazy_import('re')
+    name = env.get('COMPOSE_PROJECT_NAME')
+    if not name:
+        files = [command[i + 1] for i, arg in enumerate(command[:-1]) if arg == '-f']
+        name = os.path.basename(os.path.dirname(os.path.join(cwd, files[0])) if files else cwd)
+    return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+def _service_container(engine, project, service):
+    filters = json.dumps({'label': ['com.docker.compose.project=' + project, 'com.docker.compose.service=' + service,
+                                    'com.docker.compose.oneoff=False'], 'status': ['running']})
+    containers = engine.get('/containers/json?filters=' + _lazy_import('urllib.parse').quote(filters))
+    containers.sort(key=lambda c: int((c.get('Labels') or {}).get('com.docker.compose.container-number') or 0))
+    return containers[0]['Id'] if containers else None
+
+def _daemon_translate(engine, request):
+    '''The `docker exec`/`docker logs` equivalent of a docker-compose command, or None to run it as-is'''
+    command = request['command']
+    i = 1
+    while command[i] == '-f':
+        i += 2
+    op, rest = command[i], command[i + 1:]
+    flags = []
+    if op == 'exec':
+        detach = no_tty = False
+        while rest[0].startswith('-'):
+            opt = rest.pop(0)
+            name, _, value = opt.partition('=')
+            if opt in ('-d', '--detach'):
+                detach = True
+                flags.append('-d')
+            elif opt == '-T':
+                no_tty = True
+            elif opt == '--privileged':
+                flags.append(opt)
+            elif name in ('-u', '--user', '-e', '--env', '-w', '--workdir'):
+                flags += [name, value or rest.pop(0)]
+            else:
+                return None
+        service = rest.pop(0)
+        if not detach:
+            flags.append('-i')
+            if not no_tty and request.get('tty'):
+                flags.append('-t')
+    elif op == 'logs':
+        while rest and rest[0].startswith('-'):
+            opt = rest.pop(0)
+            name, _, value = opt.partition('=')
+            if opt in ('-f', '--follow', '-t', '--timestamps'):
+                flags.append(opt)
+            elif name == '--tail':
+                flags += ['--tail', value or rest.pop(0)]
+            elif opt != '--no-color':
+                return None
+        if len(rest) != 1:
+            return None
+        service, rest = rest[0], []
+    else:
+        return None
+
+    project = _compose_project_name(command, request['cwd'], request['env'])
+    container = _service_container(engine, project, service)
+    if not container:
+        return None
+    return ['docker', op] + flags + [container] + rest
+
+def _daemon_handle(conn, request, fds, engine, state):
+    op = request.get('op') if isinstance(request, dict) else None
+    if op == 'ping':
+        return {'pid': os.getpid(), 'started': state['started'], 'served': state['served'], 'engine': bool(engine)}
+    if op == 'stop':
+        state['stop'] = True
+        return {'stopping': os.getpid()}
+    if op != 'run' or len(fds) != 3:
+        return {'error': 'bad request'}
+
+    command = None
+    if engine:
+        try:
+            command = _daemon_translate(engine, request)
+        except (OSError, ValueError, IndexError):
+            command = None
+    command = command or request['command']
+    proc = subprocess.Popen(command, stdin=fds[0], stdout=fds[1], stderr=fds[2], cwd=request['cwd'],
+                            env=request['env'])
+    while True:
+        try:
+            return {'returncode': proc.wait(timeout=0.2), 'command': command}
+        except subprocess.TimeoutExpired:
+            pass
+        if select.select([conn], [], [], 0)[0] and not conn.recv(1):
+            # The client went away (Ctrl-C), so nobody is waiting on this any more
+            proc.terminate()
+            proc.wait()
+            return None
+
+def _daemon_serve_connection(conn, engine, state):
+    fds = []
+    try:
+        request, fds = _daemon_recv(conn, maxfds=3)
+        reply = _daemon_handle(conn, request, fds, engine, state)
+        if reply is not None:
+            conn.sendall((json.dumps(reply) + '\n').encode())
+    except (OSError, ValueError) as e:
+        print('hey daemon: dropped a request:', e, file=sys.stderr)
+    finally:
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+def _daemon_serve(path, engine_socket=None):
+    '''Accept requests on `path` until a stop request arrives'''
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    server.settimeout(0.5)
+    engine = _DockerEngine(engine_socket) if engine_socket else None
+    state = {'started': _lazy_import('time').time(), 'served': 0, 'stop': False}
+    try:
+        while not state['stop']:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            conn.setblocking(True)
+            if _daemon_peer_uid(conn, path) != os.getuid():
+                conn.close()
+                continue
+            state['served'] += 1
+            threading.Thread(target=_daemon_serve_connection, args=(conn, engine, state), daemon=True).start()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+def _daemon_start(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The socket may live outside the project (see _daemon_socket_path), the log doesn't
+    os.makedirs(_cache_dir(), exist_ok=True)
+    log_path = os.path.join(_cache_dir(), 'daemon.log')
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        try:
+            _daemon_serve(path, _docker_engine_socket())
+        finally:
+            os._exit(0)
+
+    for _ in range(50):
+        status = _daemon_request({'op': 'ping'}, path)
+        if status:
+            return status
+        sleep(0.1)
+    return None
+
+# Arguments of the command running on each thread (see _invoke); batch items can run side by side
+_COMMAND_ARGS = {}
+
+def _args():
+    '''The running command's arguments: what _invoke() was given, or sys.argv[2:] on the command line'''
+    args = _COMMAND_ARGS.get(_lazy_import('_thread').get_ident())
+    return list(sys.argv[2:] if args is None else args)
+
+def _invoke(func, name=None, args=None):
+    if getattr(func, 'needs_config', True):
+        _go_to_working_dir()
+    start = _profile_start()
+    started, returncode, first_record = perf_counter(), 1, len(_TIMINGS)
+    thread = _lazy_import('_thread').get_ident()
+    previous_args = _COMMAND_ARGS.get(thread)
+    if args is not None:
+        _COMMAND_ARGS[thread] = list(args)
+    try:
+        result = func()
+        returncode = 0
+        return result
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
+    except KeyboardInterrupt:
+        returncode = 130
+        raise
+    finally:
+        if args is not None:
+            _COMMAND_ARGS[thread] = previous_args
+        _profile_phase('dispatch', start)
+        # A command's output is whatever its children wrote (that hey could see)
+        children = [r for r in _TIMINGS[first_record:] if r['kind'] == 'process']
+        firsts = [r['_first'] for r in children if r['_first']]
+        _record_timing('command', name or getattr(func, '__name__', '?'), started, returncode,
+                       sum(r['bytes'] for r in children), min(firsts) if firsts else None)
+
+def _command_match(cmd, short_commands=False, args=None):
+    index = _all_commands()
+    if cmd.isdigit() and index.by_number(int(cmd)):
+        _invoke(index[index.by_number(int(cmd))], index.by_number(int(cmd)), args)
         return True
 
     if not short_commands:
-        matches = [c for c in all_commands.keys() if c.lower() == cmd.lower()]
+        matches = index.exact(cmd)
     else:
-        matches = [c for c in all_commands.keys() if c.lower().startswith(cmd.lower())]
+        matches = index.exact(cmd) or index.prefixed(cmd)
     if len(matches) == 1:
-        all_commands[matches[0]]()
+        _invoke(index[matches[0]], matches[0], args)
         return True
     elif len(matches) > 1:
         print('Shortcut "{}" matches multiple commands:'.format(cmd))
         for m in matches: print(" -", m)
     else:
         print("Command not found.")
+        suggestions = index.suggest(cmd)
+        if suggestions:
+            print("Did you mean: {}?".format(', '.join(suggestions)))
+
+def _wait_until_ready(probes, timeout=60, initial_delay=0.05, max_delay=2.0):
+    '''Run (name, probe) pairs in order until each has passed once, backing off exponentially with jitter.
+    Returns False if they haven't all passed within `timeout` seconds.'''
+    deadline = perf_counter() + timeout
+    pending = list(probes)
+    delay = initial_delay
+    while True:
+        while pending:
+            name, probe = pending[0]
+            try:
+                ready = probe()
+            except OSError:
+                ready = False
+            if not ready:
+                break
+            print('    {} ready'.format(name))
+            pending.pop(0)
+            delay = initial_delay
+        if not pending:
+            return True
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            return False
+        sleep(min(remaining, delay * random.uniform(0.5, 1.0)))
+        delay = min(max_delay, delay * 2)
+
+# Postgres answers an SSLRequest with a single byte ('S' or 'N') once the postmaster is listening
+PG_SSL_REQUEST = b'\x00\x00\x00\x08\x04\xd2\x16\x2f'
+
+def _tcp_probe(host, port, payload=None, timeout=1.0):
+    '''Ready when `host:port` accepts a connection (and, given a payload, replies to it)'''
+    def probe():
+        with socket.create_connection((host, port), timeout=timeout) as conn:
+            if payload is None:
+                return True
+            conn.sendall(payload)
+            # docker's port proxy accepts and then hangs up while nothing listens behind it
+            return conn.recv(1) != b''
+    return probe
+
+def _pg_isready_probe(service, database_name, database_user):
+    def probe():
+        r = _docker_compose(['exec', '-T', service, 'pg_isready', '-q', '-d', database_name, '-U', database_user],
+                            handle_errors=False, quiet=True)
+        return r.returncode == 0
+    return probe
+
+def _healthcheck_probe(service):
+    '''Ready when docker reports the service's compose healthcheck as healthy'''
+    container = []
+    def probe():
+        if not container:
+            r = _docker_compose(['ps', '-q', service], handle_errors=False, quiet=True)
+            if not r.stdout.strip():
+                return False
+            container.append(r.stdout.decode().split()[0])
+        r = _run(['docker', 'inspect', '-f', '{{.State.Health.Status}}', container[0]],
+                 capture_stdout=True, echo_stderr=False)
+        return r.stdout.strip() == b'healthy'
+    return probe
+
+def _service_host_port(service, container_port):
+    '''(host, port) that `container_port` of a compose service is published on, if any'''
+    for port in _compose_model().get('services', {}).get(service, {}).get('ports') or []:
+        try:
+            if isinstance(port, dict):
+                if int(port.get('target', 0)) == container_port and port.get('published'):
+                    return port.get('host_ip') or '127.0.0.1', int(port['published'])
+                continue
+            parts = str(port).split(':')
+            if len(parts) >= 2 and int(parts[-1].split('/')[0]) == container_port:
+                host = parts[0] if len(parts) == 3 else ''
+                return host if host not in ('', '0.0.0.0') else '127.0.0.1', int(parts[-2])
+        except ValueError:
+            # Port ranges and the like; not worth probing
+            continue
+    return None
+
+def _wait_for_postgres(database_name, database_user, service='postgres'):
+    '''Wait for postgres using the `readiness_probes` from hey.yml (tcp, pg_isready, healthcheck)'''
+    has_healthcheck = bool(_compose_model().get('services', {}).get(service, {}).get('healthcheck'))
+    names = CONFIG.get('readiness_probes') or ['tcp', 'healthcheck' if has_healthcheck else 'pg_isready']
+    probes = []
+    for name in names:
+        if name == 'tcp':
+            host_port = _service_host_port(service, 5432)
+            if host_port:
+                probes.append(('tcp {}:{}'.format(*host_port), _tcp_probe(*host_port, payload=PG_SSL_REQUEST)))
+        elif name == 'pg_isready':
+            probes.append((name, _pg_isready_probe(service, database_name, database_user)))
+        elif name == 'healthcheck':
+            probes.append((name, _healthcheck_probe(service)))
+        else:
+            print('Unknown readiness probe "{}", ignoring it'.format(name))
+    return _wait_until_ready(probes, timeout=CONFIG.get('readiness_timeout', 120))
+
+def _task_order(targets):
+    '''The targets and everything they depend on, dependencies first'''
+    order, visiting = [], []
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('Task dependency cycle: {}'.format(' -> '.join(visiting[visiting.index(name):] + [name])))
+        visiting.append(name)
+        for dep in TASKS[name]['deps']:
+            visit(dep)
+        visiting.pop()
+        order.append(name)
+    for target in targets:
+        visit(target)
+    return order
+
+def _run_task(name):
+    started = perf_counter()
+    up_to_date = TASKS[name]['up_to_date']
+    if up_to_date and up_to_date():
+        return 'up to date', perf_counter() - started
+    TASKS[name]['func']()
+    return 'done', perf_counter() - started
+
+def _run_tasks(targets, workers=None):
+    '''Run the targets and their dependencies once each, running independent tasks in parallel.
+    Nothing new is started once a task fails; hey exits after the running ones finish.'''
+    futures = _lazy_import('concurrent.futures')
+    order = _task_order(targets)
+    done, failed, running = set(), [], {}
+    with futures.ThreadPoolExecutor(max_workers=workers or CONFIG.get('task_workers', 4)) as pool:
+        while True:
+            if not failed:
+                for name in order:
+                    if name not in done and name not in running and all(d in done for d in TASKS[name]['deps']):
+                        print('[{}] starting'.format(name))
+                        running[name] = pool.submit(_run_task, name)
+            if not running:
+                break
+            finished, _ = futures.wait(running.values(), return_when=futures.FIRST_COMPLETED)
+            for name, future in list(running.items()):
+                if future not in finished:
+                    continue
+                del running[name]
+                try:
+                    status, seconds = future.result()
+                except BaseException as e:
+                    # _handle_err() exits, which surfaces here as SystemExit
+                    failed.append(name)
+                    print('[{}] failed{}'.format(name, '' if isinstance(e, SystemExit) else ': {!r}'.format(e)))
+                else:
+                    done.add(name)
+                    print('[{}] {} in {:.1f}s'.format(name, status, seconds))
+    if failed:
+        skipped = [name for name in order if name not in done and name not in failed]
+        print('Failed: {}{}'.format(', '.join(failed), '; not run: ' + ', '.join(skipped) if skipped else ''))
+        sys.exit(1)
 
 def _run_command(command_array, shell=False, *args, **kwargs):
     print('Command: ', '`', ' '.join(command_array).strip(), '`', sep='')
-    cmd = subprocess.run(command_array, stderr=subprocess.PIPE, shell=shell, *args, **kwargs)
-    return _handle_err(cmd)
+    return _handle_err(_run(command_array, shell=shell, *args, **kwargs))
 
 @command
 def bash():
@@ -160,14 +1135,211 @@ def shell():
 
 @command
 def test():
-    '''Run the unit test suite with pytest'''
+    '''Run the unit test suite with pytest (--changed[=REF] for affected tests only, --shards N to split it)'''
     print('Running tests...')
-    args = ''
-    if len(sys.argv) > 2:
-        args = ' '.join(sys.argv[2:])
-    print(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c', 'cd /code/django; pytest {}'.format(args)])
-    _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
-                                  'cd /code/django; pytest {}'.format(args)])
+    options, pytest_args = _test_options(_args())
+    if options.changed is None and options.shards <= 1:
+        args = ' '.join(pytest_args)
+        print(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c', 'cd /code/django; pytest {}'.format(args)])
+        _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
+                                      'cd /code/django; pytest {}'.format(args)])
+        return
+    _run_test_shards(options, pytest_args)
+
+# Changing one of these can change how any test runs, so --changed runs the whole suite
+TEST_GLOBAL_FILES = ['conftest.py', 'pytest.ini', 'setup.cfg', 'tox.ini', 'pyproject.toml', 'requirements.txt']
+
+def _test_options(args):
+    argparse = _lazy_import('argparse')
+    parser = argparse.ArgumentParser(prog='hey test', add_help=False)
+    parser.add_argument('--changed', nargs='?', const=CONFIG.get('test_base_ref', 'HEAD'), default=None)
+    parser.add_argument('--shards', type=int, default=CONFIG.get('test_shards', 1))
+    return parser.parse_known_args(args)
+
+def _is_test_file(path):
+    name = os.path.basename(path)
+    return name.endswith('.py') and (name.startswith('test_') or name.endswith('_test.py'))
+
+def _python_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in ('node_modules', '__pycache__')]
+        for filename in filenames:
+            if filename.endswith('.py'):
+                yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+def _module_name(path):
+    parts = path[:-3].split(os.sep)
+    if parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+def _file_imports(path, module):
+    '''Every module a file imports, and the packages those live in, with relative imports resolved'''
+    ast = _lazy_import('ast')
+    try:
+        with open(path, 'rb') as stream:
+            tree = ast.parse(stream.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return []
+    package = module.split('.') if path.endswith('__init__.py') else module.split('.')[:-1]
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            targets = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                base = '.'.join(package[:len(package) - node.level + 1] + ([base] if base else []))
+            # `from a import b` may import the module a.b or just a name from a
+            targets = [base] + ['{}.{}'.format(base, alias.name) if base else alias.name for alias in node.names]
+        else:
+            continue
+        for target in targets:
+            parts = target.split('.')
+            names.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return sorted(n for n in names if n)
+
+def _import_index(root):
+    '''{file: modules it imports} for every python file under root. Kept in .hey/test_deps.json so only
+    files whose mtime or size changed are parsed again.'''
+    cache_path = os.path.join(_cache_dir(), 'test_deps.json')
+    cached = _read_json(cache_path, {})
+    cached_files = cached.get('files', {}) if cached.get('root') == root else {}
+    files, parsed = {}, 0
+    for path in _python_files(root):
+        key = _stat_key(os.path.join(root, path))
+        entry = cached_files.get(path)
+        if not entry or entry[0] != key:
+            entry = [key, _file_imports(os.path.join(root, path), _module_name(path))]
+            parsed += 1
+        files[path] = entry
+    if parsed or len(files) != len(cached_files):
+        _write_json(cache_path, {'root': root, 'files': files})
+    return {path: entry[1] for path, entry in files.items()}
+
+def _changed_files(ref, root):
+    '''Files under root that differ from ref (committed, staged or not) or are untracked, relative to root'''
+    def git(*args):
+        return _handle_err(_run(['git'] + list(args), capture_stdout=True, cwd=root)).stdout.decode(errors='replace').splitlines()
+    toplevel = git('rev-parse', '--show-toplevel')[0]
+    paths = git('diff', '--name-only', ref, '--') + git('ls-files', '--others', '--exclude-standard', '--full-name')
+    changed = set()
+    for path in paths:
+        relative = os.path.relpath(os.path.join(toplevel, path), os.path.realpath(root))
+        if not relative.startswith(os.pardir + os.sep):
+            changed.add(relative)
+    return sorted(changed)
+
+def _affected_tests(root, changed):
+    '''Test files that are changed themselves or import (however indirectly) a changed module.
+    None means run everything.'''
+    if any(os.path.basename(path) in TEST_GLOBAL_FILES for path in changed):
+        return None
+    index = _import_index(root)
+    modules = {_module_name(path): path for path in index}
+    importers = {}
+    for path, imports in index.items():
+        for name in imports:
+            if name in modules:
+                importers.setdefault(modules[name], set()).add(path)
+    affected, pending = set(), [path for path in changed if path in index]
+    while pending:
+        path = pending.pop()
+        if path not in affected:
+            affected.add(path)
+            pending.extend(importers.get(path, ()))
+    return sorted(path for path in affected if _is_test_file(path))
+
+def _test_durations_path():
+    return os.path.join(_cache_dir(), 'test_durations.json')
+
+def _shard_tests(files, durations, shards):
+    '''Split test files into shards of about equal recorded duration (longest first onto the lightest shard)'''
+    known = [durations[f] for f in files if f in durations]
+    default = sum(known) / len(known) if known else 1.0
+    bins = [[0.0, i, []] for i in range(max(1, shards))]
+    for path in sorted(files, key=lambda f: -durations.get(f, default)):
+        lightest = min(bins)
+        lightest[0] += durations.get(path, default)
+        lightest[2].append(path)
+    return [(seconds, files) for seconds, _, files in bins if files]
+
+def _merge_junit(reports, container_root):
+    '''One <testsuites> of every shard's suites, plus (seconds, file, test id, outcome) for each test case'''
+    ElementTree = _lazy_import('xml.etree.ElementTree')
+    merged = ElementTree.Element('testsuites')
+    cases = []
+    for report in reports:
+        try:
+            root = ElementTree.fromstring(report)
+        except ElementTree.ParseError:
+            continue
+        for suite in [root] if root.tag == 'testsuite' else root.findall('testsuite'):
+            merged.append(suite)
+            for case in suite.iter('testcase'):
+                outcome = next((c.tag for c in case if c.tag in ('failure', 'error', 'skipped')), 'passed')
+                path = case.get('file') or ''
+                if path.startswith(container_root + '/'):
+                    path = path[len(container_root) + 1:]
+                cases.append((float(case.get('time') or 0), path,
+                              '{}::{}'.format(case.get('classname'), case.get('name')), outcome))
+    return ElementTree.ElementTree(merged), cases
+
+def _run_test_shards(options, pytest_args):
+    container = CONFIG.get('default_container', 'django')
+    root = CONFIG.get('test_root', 'django')
+    container_root = CONFIG.get('test_container_root', '/code/django')
+    tests = None
+    if options.changed is not None:
+        changed = _changed_files(options.changed, root)
+        tests = _affected_tests(root, changed)
+        if tests is None:
+            print('{} file(s) changed since {}, including test configuration: running everything'.format(
+                len(changed), options.changed))
+        elif not tests:
+            print('{} file(s) changed since {}, no tests affected.'.format(len(changed), options.changed))
+            return
+        else:
+            print('{} file(s) changed since {}, {} test file(s) affected'.format(len(changed), options.changed, len(tests)))
+    if tests is None:
+        tests = sorted(path for path in _python_files(root) if _is_test_file(path))
+
+    durations = _read_json(_test_durations_path(), {})
+    shards = _shard_tests(tests, durations, options.shards)
+    commands, reports = {}, {}
+    for i, (seconds, files) in enumerate(shards):
+        name = 'shard {}'.format(i + 1)
+        reports[name] = '/tmp/hey-junit-{}-{}.xml'.format(os.getpid(), i + 1)
+        print('{}: {} file(s), ~{:.1f}s'.format(name, len(files), seconds))
+        pytest = ['pytest', '-o', 'junit_family=xunit1', '--junitxml=' + reports[name]] + files + pytest_args
+        commands[name] = _compose_command(['exec', '-T', container, 'bash', '-c',
+                                           'cd {}; {}'.format(shlex.quote(container_root), shlex.join(pytest))])
+    results = _fan_out(commands, len(commands), label='shard', exit_on_failure=False)
+
+    fetched = _run_many([_compose_command(['exec', '-T', container, 'sh', '-c', 'cat {0} && rm -f {0}'.format(path)])
+                         for path in reports.values()], capture_stdout=True, echo_stderr=False)
+    merged, cases = _merge_junit([r.stdout for r in fetched if r.returncode == 0], container_root)
+    junit_path = CONFIG.get('test_junit', os.path.join(_cache_dir(), 'junit.xml'))
+    os.makedirs(os.path.dirname(os.path.abspath(junit_path)), exist_ok=True)
+    merged.write(junit_path, encoding='utf-8', xml_declaration=True)
+
+    file_seconds = {}
+    for seconds, path, _, _ in cases:
+        if path:
+            file_seconds[path] = file_seconds.get(path, 0) + seconds
+    durations.update(file_seconds)
+    _write_json(_test_durations_path(), durations)
+
+    slowest = sorted(cases, reverse=True)[:CONFIG.get('test_slowest', 10)]
+    if slowest:
+        print('\nSlowest tests:')
+        for seconds, _, test_id, outcome in slowest:
+            print('{:>8.2f}s  {:<7}  {}'.format(seconds, outcome, test_id))
+    outcomes = collections.Counter(case[3] for case in cases)
+    print('\n{} tests: {}. JUnit report: {}'.format(len(cases), ', '.join(
+        '{} {}'.format(n, outcome) for outcome, n in sorted(outcomes.items())) or 'none ran', junit_path))
+    if any(returncode != 0 for _, returncode, _ in results):
+        sys.exit(1)
 
 @command
 def mail():
@@ -176,20 +1348,254 @@ def mail():
     _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
                      'python -m smtpd -n -c DebuggingServer localhost:2525'])
 
+LOG_LEVELS = {'TRACE': 5, 'DEBUG': 10, 'INFO': 20, 'NOTICE': 25, 'WARN': 30, 'WARNING': 30,
+              'ERR': 40, 'ERROR': 40, 'CRITICAL': 50, 'FATAL': 50, 'PANIC': 50}
+
+class _LogFilter:
+    '''Compiled --grep patterns and a minimum --level; lines with no recognisable level count as INFO'''
+    def __init__(self, patterns=(), level=None):
+        re = _lazy_import('re')
+        self.pattern = re.compile('|'.join('(?:{})'.format(p) for p in patterns)) if patterns else None
+        self.min_level = LOG_LEVELS[level.upper()] if level else None
+        self.level_pattern = re.compile(r'\b({})\b'.format('|'.join(LOG_LEVELS)), re.IGNORECASE)
+
+    def __call__(self, message):
+        if self.pattern is not None and not self.pattern.search(message):
+            return False
+        if self.min_level is not None:
+            match = self.level_pattern.search(message, 0, 200)
+            if (LOG_LEVELS[match.group(1).upper()] if match else 20) < self.min_level:
+                return False
+        return True
+
+def _log_sort_key(timestamp):
+    '''RFC 3339 timestamps compare as strings once the fraction is padded (docker trims trailing zeros)'''
+    if '.' not in timestamp:
+        return timestamp.rstrip('Z') + '.000000000'
+    base, fraction = timestamp.rstrip('Z').split('.', 1)
+    return base + '.' + fraction.ljust(9, '0')
+
+class _LogMerger:
+    '''Merge timestamped lines from several streams into timestamp order. Live streams can't be fully
+    sorted, so a line is held back for `window` seconds after it arrives in case an earlier one turns up.'''
+    def __init__(self, window=0.25):
+        self.window = window
+        self.heap = []
+        self.seq = 0
+        self.last_key = {}
+        heapq = _lazy_import('heapq')
+        self.heappush, self.heappop = heapq.heappush, heapq.heappop
+
+    def push(self, source, line, arrival):
+        '''Add a "<timestamp> <message>" line; one without a timestamp sorts after its stream's previous line'''
+        timestamp, _, message = line.partition(' ')
+        if timestamp[:1].isdigit() and 'T' in timestamp:
+            key = self.last_key[source] = _log_sort_key(timestamp)
+        else:
+            key = self.last_key.get(source, '')
+            message = line
+        self.seq += 1
+        self.heappush(self.heap, (key, self.seq, arrival, source, message))
+
+    def pop_ready(self, now=None):
+        '''Lines whose hold-back window has passed (everything, when now is None), in order'''
+        heap, heappop, ready = self.heap, self.heappop, []
+        cutoff = None if now is None else now - self.window
+        while heap and (cutoff is None or heap[0][2] <= cutoff):
+            key, _, _, source, message = heappop(heap)
+            ready.append((key, source, message))
+        return ready
+
+class _RollingCapture:
+    '''gzip capture that starts a new file every `max_bytes` of log text, keeping the newest `keep` files'''
+    def __init__(self, prefix, max_bytes=50 << 20, keep=5):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.stream = None
+        self.written = 0
+        self.count = 0
+
+    def _roll(self):
+        if self.stream:
+            self.stream.close()
+        self.count += 1
+        path = '{}-{}-{:03d}.log.gz'.format(self.prefix, _lazy_import('time').strftime('%Y%m%d-%H%M%S'), self.count)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.stream = _lazy_import('gzip').open(path, 'wb', compresslevel=3)
+        self.written = 0
+        directory, base = os.path.split(os.path.abspath(self.prefix))
+        old = sorted(f for f in os.listdir(directory) if f.startswith(base + '-') and f.endswith('.log.gz'))
+        for name in old[:-self.keep]:
+            os.remove(os.path.join(directory, name))
+
+    def write(self, data):
+        if self.stream is None or self.written >= self.max_bytes:
+            self._roll()
+        self.stream.write(data)
+        self.written += len(data)
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+
+def _parse_log_line(source, raw):
+    '''(source, "<timestamp> <message>") from a `docker-compose logs -t` or `kubectl logs --prefix` line'''
+    line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+    if source is None and line.startswith('['):
+        # kubectl: "[pod/www-5d8f/django] 2026-10-17T17:00:00.123Z message"
+        prefix, _, line = line.partition('] ')
+        return prefix[1:].replace('pod/', '', 1), line
+    if source is not None and ' | ' in line[:80]:
+        line = line.split(' | ', 1)[1]
+    return source, line
+
+async def _aggregate_logs(sources, log_filter, merger, out, capture=None, timestamps=False):
+    '''Follow several log commands at once. Readers feed a bounded queue, so a slow terminal stalls the
+    readers and, through their pipes, docker-compose/kubectl, instead of buffering without limit.'''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=CONFIG.get('log_queue_lines', 10000))
+    procs, failures = [], []
+
+    async def read(source, command):
+        try:
+            proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.DEVNULL)
+            procs.append(proc)
+            async for raw in _read_lines(proc.stdout):
+                await queue.put(_parse_log_line(source, raw))
+            await proc.wait()
+        except Exception as e:
+            failures.append(source or command[0])
+            print('There was a problem following {}: {}'.format(source or ' '.join(command[:2]), e), flush=True)
+        finally:
+            # Always, or the loop below would wait for this reader forever
+            await queue.put(None)
+
+    readers = [asyncio.ensure_future(read(source, command)) for source, command in sources]
+    width = max([len(s) for s, _ in sources if s] + [12])
+    running = len(readers)
+    try:
+        while running:
+            try:
+                item = await asyncio.wait_for(queue.get(), merger.window)
+            except asyncio.TimeoutError:
+                item = False
+            now = loop.time()
+            while item is not False:
+                if item is None:
+                    running -= 1
+                else:
+                    merger.push(item[0], item[1], now)
+                item = queue.get_nowait() if not queue.empty() else False
+            lines = merger.pop_ready(None if not running else now)
+            if not lines:
+                continue
+            text = ''.join('{:<{}} | {}{}\n'.format(source, width, key + ' ' if timestamps and key else '', message)
+                           for key, source, message in lines if log_filter(message)).encode()
+            if capture:
+                capture.write(''.join('{} {} {}\n'.format(key, source, message) for key, source, message in lines).encode())
+            # A blocking write is the backpressure: nothing is read while the terminal catches up
+            out.write(text)
+            out.flush()
+    finally:
+        for reader in readers:
+            reader.cancel()
+        for proc in procs:
+            await _terminate(proc)
+        if capture:
+            capture.close()
+    return failures
+
+def _logs_aggregate(args):
+    argparse = _lazy_import('argparse')
+    parser = argparse.ArgumentParser(prog='hey logs', description='Merge logs of several services/pods by timestamp')
+    parser.add_argument('services', nargs='*', help='compose services (default: all of them, unless --kube is given)')
+    parser.add_argument('--follow', action='store_true', help='keep following new lines')
+    parser.add_argument('--tail', default='10', help='lines of history per stream (default 10)')
+    parser.add_argument('--grep', action='append', default=[], help='only lines matching this regex (repeatable)')
+    parser.add_argument('--level', choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get), type=str.upper,
+                        help='only lines at or above this level')
+    parser.add_argument('--kube', action='append', default=[], metavar='SELECTOR', help='also follow pods matching a label selector')
+    parser.add_argument('--capture', metavar='PREFIX', help='write everything to rolling gzip files PREFIX-*.log.gz')
+    parser.add_argument('--timestamps', action='store_true', help='show timestamps')
+    parser.add_argument('--window', type=float, default=CONFIG.get('log_merge_window', 0.25),
+                        help='seconds to hold lines back for reordering (default 0.25)')
+    options = parser.parse_args(args)
+
+    services = options.services
+    if not services and not options.kube:
+        services = list(_compose_model().get('services', {}))
+    follow = ['-f'] if options.follow else []
+    sources = [(service, _compose_command(['logs', '--no-color', '-t', '--tail', options.tail] + follow + [service]))
+               for service in services]
+    sources += [(None, ['kubectl', 'logs', '-l', selector, '--all-containers', '--prefix', '--timestamps',
+                        '--tail', options.tail, '--max-log-requests', str(CONFIG.get('kube_max_log_requests', 50))] + follow)
+                for selector in options.kube]
+    capture = None
+    if options.capture:
+        capture = _RollingCapture(options.capture, int(CONFIG.get('log_capture_mb', 50) * (1 << 20)),
+                                  CONFIG.get('log_capture_keep', 5))
+    out = _binary_stream(sys.stdout) or sys.stdout
+    try:
+        failures = asyncio.run(_aggregate_logs(sources, _LogFilter(options.grep, options.level),
+                                               _LogMerger(options.window), out, capture, options.timestamps))
+    except KeyboardInterrupt:
+        return
+    if failures:
+        sys.exit(1)
+
+# Options that switch `hey logs` from plain docker-compose logs to the aggregator
+LOG_AGGREGATOR_FLAGS = ['--follow', '--grep', '--level', '--kube', '--capture', '--timestamps', '--window']
+
 @command
 def logs():
-    '''Most recent container log lines (default: last 10 of django)'''
+    '''Most recent container log lines (default: last 10 of django); --follow/--grep/--level/--kube merge many'''
+    args = _args()
+    if any(a.split('=', 1)[0] in LOG_AGGREGATOR_FLAGS for a in args):
+        return _logs_aggregate(args)
     print('Showing logs. HINT: you can add `--tail <num>` and/or a container name...')
     args = ['--tail', '10', CONFIG.get('default_container', 'django')]
-    if len(sys.argv) > 2:
-        args = sys.argv[2:]
+    if _args():
+        args = _args()
     _docker_compose(['logs'] + args)
 
 @command(noninteractive=True)
 def dc():
     '''Run docker-compose commands with the config file pre-set'''
-    if len(sys.argv) > 2:
-        _docker_compose(sys.argv[2:])
+    if _args():
+        _docker_compose(_args())
+
+@command(noninteractive=True)
+def daemon():
+    '''Serve docker-compose exec/logs/up from a long-lived helper (start|stop|status|run)'''
+    action = _args()[0] if _args() else 'status'
+    path = _daemon_socket_path()
+    status = _daemon_request({'op': 'ping'}, path)
+    if action == 'start':
+        if not status:
+            status = _daemon_start(path)
+            if not status:
+                print('The daemon did not come up, see', os.path.join(_cache_dir(), 'daemon.log'))
+                sys.exit(1)
+        print('hey daemon running (pid {}) on {}'.format(status['pid'], path))
+    elif action == 'stop':
+        if status:
+            _daemon_request({'op': 'stop'}, path)
+            print('Stopped hey daemon (pid {})'.format(status['pid']))
+        else:
+            print('hey daemon is not running')
+    elif action == 'run':
+        print('Serving on {} (Ctrl-C to stop)...'.format(path))
+        try:
+            _daemon_serve(path, _docker_engine_socket())
+        except KeyboardInterrupt:
+            pass
+    elif status:
+        print('hey daemon running (pid {}) on {}, {} requests served{}'.format(
+            status['pid'], path, status['served'], '' if status['engine'] else ', no docker engine socket'))
+    else:
+        print('hey daemon is not running; commands fork docker-compose directly')
 
 def sstop():
     '''Stop all supervisor jobs'''
@@ -206,8 +1612,8 @@ def up():
     '''\t Start (or recreate) the containers'''
     print('Re-creating the containers...')
     args = []
-    if len(sys.argv) > 2:
-        args = sys.argv[2:]
+    if _args():
+        args = _args()
     _docker_compose(['up'] + args)
 
 @command
@@ -229,105 +1635,791 @@ def get_scp_command():
         scp = 'C:/Program Files/Git/usr/bin/scp'
     return scp
 
+def get_ssh_command():
+    ssh = 'ssh'
+    if os.name == 'nt':
+        ssh = 'C:/Program Files/Git/usr/bin/ssh'
+    return ssh
+
+def _human_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} TB'.format(n)
+
+class _SSHTransport:
+    '''Backups on a remote host, read with plain ssh over one multiplexed control connection'''
+    def __init__(self, host, directory):
+        self.host = host
+        self.directory = directory
+
+    def _ssh(self, remote_command):
+        command = [get_ssh_command()]
+        if os.name != 'nt':
+            os.makedirs(_user_cache_dir(), exist_ok=True)
+            command += ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=60',
+                        '-o', 'ControlPath={}'.format(os.path.join(_user_cache_dir(), 'ssh-%C'))]
+        return command + [self.host, remote_command]
+
+    def _path(self, name):
+        return shlex.quote('{}/{}'.format(self.directory, name))
+
+    def latest(self):
+        '''(name, size) of the newest backup'''
+        cmd = _handle_err(_run(self._ssh('cd {} && f=$(ls -1r | grep -v "\\.sha256$" | head -1) && echo "$f" && stat -c %s "$f"'.format(
+            shlex.quote(self.directory))), capture_stdout=True, echo_stderr=False))
+        name, size = cmd.stdout.decode().strip().rsplit('\n', 1)
+        return name, int(size)
+
+    def open_range(self, name, offset, length=None):
+        '''A stream of `length` bytes (default: the rest) from `offset`, and a function returning an error message or None'''
+        remote_command = 'tail -c +{} {}'.format(offset + 1, self._path(name))
+        if length is not None:
+            remote_command += ' | head -c {}'.format(length)
+        proc = subprocess.Popen(self._ssh(remote_command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        def finish():
+            err = proc.stderr.read()
+            proc.stdout.close()
+            return err.decode(errors='ignore').strip() or None if proc.wait() else None
+        return proc.stdout, finish
+
+    def checksum(self, name):
+        cmd = _run(self._ssh('cat {0}.sha256 2>/dev/null || sha256sum {0}'.format(self._path(name))),
+                   capture_stdout=True, echo_stderr=False)
+        return cmd.stdout.decode().split()[0] if cmd.returncode == 0 and cmd.stdout.strip() else None
+
+class _LocalTransport:
+    '''Backups in a local or mounted folder (`backup_host: file://<folder>`)'''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def latest(self):
+        names = sorted((f for f in os.listdir(self.directory) if not f.endswith('.sha256')), reverse=True)
+        if not names:
+            print('There was a problem: no backups in', self.directory)
+            sys.exit(1)
+        return names[0], os.path.getsize(os.path.join(self.directory, names[0]))
+
+    def open_range(self, name, offset, length=None):
+        stream = open(os.path.join(self.directory, name), 'rb')
+        stream.seek(offset)
+        def finish():
+            stream.close()
+        return stream, finish
+
+    def checksum(self, name):
+        return _file_sha256(os.path.join(self.directory, name))
+
+def _backup_transport():
+    host = CONFIG.get('backup_host', 'jakea@atc-de01.aluminumtrailer.local')
+    if host.startswith('file://'):
+        return _LocalTransport(host[len('file://'):])
+    return _SSHTransport(host, CONFIG.get('backup_dir', '/home/dev.bot/Public'))
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _download_state(state_path, name, size, connections):
+    '''Byte ranges still to fetch, resumed from a previous run of the same file when there is one'''
+    state = _read_json(state_path, {})
+    if isinstance(state, dict) and state.get('name') == name and state.get('size') == size:
+        return state
+    # Ranges smaller than 8 MB aren't worth another connection
+    connections = max(1, min(connections, size // (8 << 20)))
+    bounds = [size * i // connections for i in range(connections + 1)]
+    # [start, end, bytes done]
+    return {'name': name, 'size': size, 'chunks': [[bounds[i], bounds[i + 1], 0] for i in range(connections)]}
+
+def _save_download_state(state_path, state, lock):
+    with lock:
+        data = json.dumps(state)
+    _atomic_write(state_path, lambda stream: stream.write(data))
+
+def _download(transport, name, size, dest, connections=4, verify=True):
+    '''Fetch `name` into `dest` over parallel ranged reads, resuming any earlier partial download.
+    Returns the sha256 of the file when it was verified, otherwise None.'''
+    part_path = dest + '.part'
+    state_path = part_path + '.json'
+    state = _download_state(state_path, name, size, connections)
+    if not os.path.exists(part_path):
+        for chunk in state['chunks']:
+            chunk[2] = 0
+        with open(part_path, 'wb') as stream:
+            stream.truncate(size)
+    lock = threading.Lock()
+    done = sum(c[2] for c in state['chunks'])
+    progress = {'bytes': 0, 'errors': []}
+    if done:
+        print('    Resuming from {}'.format(_human_bytes(done)))
+
+    expected = {}
+    checker = None
+    if verify:
+        checker = threading.Thread(target=lambda: expected.update(sha256=transport.checksum(name)), daemon=True)
+        checker.start()
+
+    def fetch(chunk):
+        error = None
+        for attempt in range(3):
+            offset = chunk[0] + chunk[2]
+            if offset >= chunk[1]:
+                return
+            stream = None
+            try:
+                stream, finish = transport.open_range(name, offset, chunk[1] - offset)
+                # Unbuffered, so a byte counted in the state file is a byte handed to the OS
+                with open(part_path, 'r+b', buffering=0) as out:
+                    out.seek(offset)
+                    while offset < chunk[1]:
+                        block = stream.read(min(1 << 20, chunk[1] - offset))
+                        if not block:
+                            break
+                        out.write(block)
+                        offset += len(block)
+                        with lock:
+                            chunk[2] += len(block)
+                            progress['bytes'] += len(block)
+                error = finish()
+            except Exception as e:
+                # A failed connection or write (disk full...) must not look like a finished range
+                error = '{}: {}'.format(type(e).__name__, e)
+                if stream is not None:
+                    stream.close()
+                    finish()
+        if chunk[0] + chunk[2] < chunk[1]:
+            progress['errors'].append(error or 'connection closed early')
+
+    workers = [threading.Thread(target=fetch, args=(c,), daemon=True) for c in state['chunks'] if c[0] + c[2] < c[1]]
+    started = perf_counter()
+    try:
+        for worker in workers:
+            worker.start()
+        while any(w.is_alive() for w in workers):
+            for worker in workers:
+                worker.join(timeout=1)
+                if worker.is_alive():
+                    break
+            _save_download_state(state_path, state, lock)
+            elapsed = perf_counter() - started
+            print('\r    {} / {}  {}/s   '.format(_human_bytes(done + progress['bytes']), _human_bytes(size),
+                                                   _human_bytes(progress['bytes'] / max(elapsed, 1e-3))), end='', flush=True)
+    except KeyboardInterrupt:
+        _save_download_state(state_path, state, lock)
+        print('\nInterrupted; run `hey getbackup` again to resume.')
+        raise
+    _save_download_state(state_path, state, lock)
+    elapsed = perf_counter() - started
+    print('\n    Fetched {} in {:.1f}s ({}/s over {} connection(s))'.format(
+        _human_bytes(progress['bytes']), elapsed, _human_bytes(progress['bytes'] / max(elapsed, 1e-3)), len(workers)))
+    missing = sum(c[1] - c[0] - c[2] for c in state['chunks'] if c[0] + c[2] < c[1])
+    if progress['errors'] or missing:
+        print('There was a problem:', progress['errors'][0] if progress['errors'] else
+              '{} still missing'.format(_human_bytes(missing)), '(run `hey getbackup` again to resume)')
+        sys.exit(1)
+
+    digest = None
+    if checker:
+        checker.join()
+        if not expected.get('sha256'):
+            print('    No remote checksum available, skipping verification')
+        elif _file_sha256(part_path) != expected['sha256']:
+            print('There was a problem: checksum mismatch for {}, removing the download'.format(name))
+            os.remove(part_path)
+            os.remove(state_path)
+            sys.exit(1)
+        else:
+            digest = expected['sha256']
+            print('    Checksum OK')
+    os.replace(part_path, dest)
+    os.remove(state_path)
+    return digest
+
+def _make_shared_dir(path):
+    '''Create a folder the rest of its group can write to too. setgid, so what is created inside keeps the
+    group; a shared backup_store only needs its parent to belong to the devs' common group.'''
+    if os.path.isdir(path):
+        return
+    os.makedirs(path, exist_ok=True)
+    if os.name != 'nt':
+        try:
+            os.chmod(path, 0o2775)
+        except OSError:
+            pass
+
+class _BackupStore:
+    '''Backups stored by content (objects/<sha256>) with an index of remote name -> hash.
+    Use as a context manager around reading or updating the index: the store is locked for that long, so
+    several users can share one. Keep transfers outside it, downloading into incoming_path() first.'''
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.index = None
+        self.lock = None
+
+    def __enter__(self):
+        _make_shared_dir(self.path)
+        _make_shared_dir(os.path.join(self.path, 'objects'))
+        # Read-only is enough for flock, and lets everyone lock a file only its creator can write
+        self.lock = os.open(os.path.join(self.path, 'lock'), os.O_RDONLY | os.O_CREAT, 0o666)
+        if os.name != 'nt':
+            fcntl = _lazy_import('fcntl')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('Waiting for someone else using the backup store at {}...'.format(self.path))
+                fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.index = _read_json(self.index_path, None) or {'names': {}, 'objects': {}}
+        return self
+
+    def __exit__(self, *exc):
+        if not _write_json(self.index_path, self.index, indent=1):
+            print('There was a problem: could not update the backup store index at {}'.format(self.index_path))
+        os.close(self.lock)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest)
+
+    def incoming_path(self, name):
+        '''Where `name` is downloaded before add(); per user, so two people fetching it don't share a .part'''
+        _make_shared_dir(os.path.join(self.path, 'incoming'))
+        return os.path.join(self.path, 'incoming', getpass.getuser(), name)
+
+    def lookup(self, name, size):
+        '''Path of the stored copy of remote backup `name`, if there is one of the right size'''
+        entry = self.index['names'].get(name)
+        if not entry or entry['size'] != size or not os.path.isfile(self.object_path(entry['sha256'])):
+            return None
+        self.index['objects'][entry['sha256']]['last_used'] = _lazy_import('time').time()
+        return self.object_path(entry['sha256'])
+
+    def add(self, name, path, digest=None):
+        '''Move a downloaded file into the store; identical content already stored is reused'''
+        digest = digest or _file_sha256(path)
+        size = os.path.getsize(path)
+        if os.path.isfile(self.object_path(digest)):
+            os.remove(path)
+        else:
+            os.replace(path, self.object_path(digest))
+        self.index['names'][name] = {'sha256': digest, 'size': size}
+        self.index['objects'][digest] = {'size': size, 'last_used': _lazy_import('time').time()}
+        return self.object_path(digest)
+
+    def evict(self, max_count=None, max_bytes=None, keep=()):
+        '''Drop least recently used objects until the store fits the limits'''
+        objects = sorted(self.index['objects'].items(), key=lambda item: item[1]['last_used'])
+        total = sum(o['size'] for _, o in objects)
+        for digest, info in objects:
+            if (max_count is None or len(self.index['objects']) <= max_count) and (max_bytes is None or total <= max_bytes):
+                break
+            if self.object_path(digest) in keep:
+                continue
+            if os.path.exists(self.object_path(digest)):
+                os.remove(self.object_path(digest))
+            del self.index['objects'][digest]
+            total -= info['size']
+            self.index['names'] = {n: e for n, e in self.index['names'].items() if e['sha256'] != digest}
+            print('    Evicted {} from the backup store'.format(digest[:12]))
+
+def _backup_store():
+    return _BackupStore(CONFIG.get('backup_store') or os.path.join(_cache_dir(), 'backups'))
+
+def _evict_backups(store, keep=()):
+    max_gb = CONFIG.get('backup_store_max_gb')
+    store.evict(max_count=CONFIG.get('backup_store_keep', 3), keep=keep,
+                max_bytes=int(max_gb * (1 << 30)) if max_gb else None)
+
+def _link_into(path, dest):
+    '''Hard link a stored backup into place (copying when that isn't possible)'''
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(path, dest)
+    except OSError:
+        _lazy_import('shutil').copyfile(path, dest)
+
 @command
 def getbackup():
     '''Download the latest prod database backup'''
     print('Checking for latest backup...')
     dirpath = _go_to_working_dir()
-    ssh = 'ssh'
-    if os.name == 'nt':
-        ssh = 'C:/Program Files/Git/usr/bin/ssh'
-    cmd = subprocess.run([ssh, 'jakea@atc-de01.aluminumtrailer.local', 'ls -1r /home/dev.bot/Public | head -1'],
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _handle_err(cmd)
-
-    latest = cmd.stdout.strip().decode()
-    print('Downloading {} to the folder {}...'.format(latest, dirpath))
-    _handle_err(subprocess.run([get_scp_command(), 'jakea@atc-de01.aluminumtrailer.local:/home/dev.bot/Public/{}'.format(latest), dirpath],
-                      stderr=subprocess.PIPE))
-    print('Download complete! Your backup file is in the folder, ready to restore.')
+    transport = _backup_transport()
+    latest, size = transport.latest()
+    dest = os.path.join(dirpath, latest)
+    if os.path.isfile(dest) and os.path.getsize(dest) == size:
+        print('{} is already in the folder {}.'.format(latest, dirpath))
+        return latest
+
+    if not CONFIG.get('backup_store_enabled', True):
+        print('Downloading {} ({}) to the folder {}...'.format(latest, _human_bytes(size), dirpath))
+        _download(transport, latest, size, dest, connections=CONFIG.get('backup_connections', 4),
+                  verify=CONFIG.get('backup_verify', True))
+        print('Download complete! Your backup file is in the folder, ready to restore.')
+        return latest
+
+    store = _backup_store()
+    # Linked while the store is locked, so nobody evicts the object in between
+    with store:
+        stored = store.lookup(latest, size)
+        if stored:
+            _link_into(stored, dest)
+    if stored:
+        print('{} is already in the backup store, skipping the download.'.format(latest))
+    else:
+        # Not under the store's lock: the transfer can take a long time
+        print('Downloading {} ({}) to the backup store {}...'.format(latest, _human_bytes(size), store.path))
+        incoming = store.incoming_path(latest)
+        os.makedirs(os.path.dirname(incoming), exist_ok=True)
+        digest = _download(transport, latest, size, incoming, connections=CONFIG.get('backup_connections', 4),
+                           verify=CONFIG.get('backup_verify', True))
+        with store:
+            stored = store.add(latest, incoming, digest)
+            _link_into(stored, dest)
+            _evict_backups(store, keep=[stored])
+    print('Your backup file is in the folder {}, ready to restore.'.format(dirpath))
     return latest
 
+@command(noninteractive=True)
+def backups():
+    '''List the local backup store (`prune` applies the retention limits now)'''
+    _go_to_working_dir()
+    with _backup_store() as store:
+        if _args()[:1] == ['prune']:
+            _evict_backups(store)
+        by_digest = {}
+        for name, entry in store.index['names'].items():
+            by_digest.setdefault(entry['sha256'], []).append(name)
+        time = _lazy_import('time')
+        for digest, info in sorted(store.index['objects'].items(), key=lambda item: -item[1]['last_used']):
+            print('{}  {:>10}  {}  {}'.format(digest[:12], _human_bytes(info['size']),
+                                             time.strftime('%Y-%m-%d %H:%M', time.localtime(info['last_used'])),
+                                             ', '.join(by_digest.get(digest, []))))
+        total = sum(o['size'] for o in store.index['objects'].values())
+        print('{} backup(s), {} in {}'.format(len(store.index['objects']), _human_bytes(total), store.path))
+
+# Leading bytes of compressed archives, and what unpacks them inside the restore container
+ARCHIVE_DECOMPRESSORS = [
+    (b'\x1f\x8b', '$(command -v pigz || echo gzip) -dc'),
+    (b'\xfd7zXZ\x00', 'xz -dc'),
+    (b'\x28\xb5\x2f\xfd', 'zstd -dc'),
+    (b'BZh', 'bzip2 -dc'),
+]
+
+def _archive_decompressor(magic):
+    return next((command for prefix, command in ARCHIVE_DECOMPRESSORS if magic.startswith(prefix)), None)
+
+def _stream_restore(volume_name, transport, name):
+    '''Pipe an archive from the transport through decompression and tar straight into the data volume.
+    The new tree is unpacked beside the old one and swapped in by rename; the old one is deleted in the background.'''
+    stream, finish = transport.open_range(name, 0, 8)
+    magic = stream.read(8)
+    finish()
+    decompress = _archive_decompressor(magic)
+    unpack = '{} | tar x -C .hey-incoming'.format(decompress) if decompress else 'tar x -C .hey-incoming'
+    script = '''set -e -o pipefail
+        cd /pg_restore_dest
+        rm -rf .hey-incoming; mkdir .hey-incoming
+        echo '    Extracting backup data'
+        {}
+        echo '    Swapping in the new data'
+        old=.hey-old-$(date +%s%N); mkdir $old
+        find . -mindepth 1 -maxdepth 1 ! -name '.hey-*' -exec mv -t $old {{}} +
+        find .hey-incoming -mindepth 1 -maxdepth 1 -exec mv -t . {{}} +
+        rmdir .hey-incoming'''.format(unpack)
+    mount = 'type=volume,src={},destination=/pg_restore_dest'.format(volume_name)
+
+    started = perf_counter()
+    stream, finish = transport.open_range(name, 0)
+    print('Command: `docker run -i --rm --mount {} ubuntu bash -c ...` < {}'.format(mount, name))
+    result = _run(['docker', 'run', '-i', '--rm', '--mount', mount, 'ubuntu', 'bash', '-c', script], stdin=stream)
+    # If the extract died early, closing our end makes the source fail on a broken pipe instead of blocking
+    stream.close()
+    source_error = finish()
+    if result.returncode != 0 or source_error:
+        print('There was a problem:', (source_error or result.stderr.decode(errors='ignore')).strip())
+        print('The old data was left in place.')
+        sys.exit(1)
+    print('    Extracted {} in {:.1f}s'.format(name, perf_counter() - started))
+    _run(['docker', 'run', '-d', '--rm', '--mount', mount, 'ubuntu', 'bash', '-c', 'rm -rf /pg_restore_dest/.hey-old-*'],
+         capture_stdout=True, echo_stderr=False)
+
+# Every pg_dump archive (and a directory-format archive's toc.dat) starts with this
+PG_DUMP_MAGIC = b'PGDMP'
+
+# Run after every restore as one transaction; {0} is the local username
+SANITIZE_SQL = '''
+UPDATE argon_users_user SET email='donotreply-{0}@aluminumtrailer.com' WHERE username='admin';
+UPDATE argon_users_user SET email='{0}@aluminumtrailer.com' WHERE username='{0}';
+UPDATE argon_users_user SET email='' WHERE username='trishz';
+
+DELETE FROM argon_users_user_groups ug WHERE group_id=5;
+
+INSERT INTO argon_users_user_groups (user_id, group_id)
+SELECT u.id, 5
+FROM argon_users_user u
+WHERE username='{0}';
+
+UPDATE argon_devices_device SET active=FALSE WHERE is_healthy=FALSE;
+'''
+
+def _dump_format(path):
+    '''"custom" or "directory" for a pg_dump -Fc/-Fd archive, going by its header; None for anything
+    else (a tarball of the data directory)'''
+    dump_format = 'custom'
+    if os.path.isdir(path):
+        path, dump_format = os.path.join(path, 'toc.dat'), 'directory'
+    try:
+        with open(path, 'rb') as stream:
+            magic = stream.read(len(PG_DUMP_MAGIC))
+    except OSError:
+        return None
+    return dump_format if magic == PG_DUMP_MAGIC else None
+
+def _peek(transport, name, length):
+    stream, finish = transport.open_range(name, 0, length)
+    data = stream.read(length)
+    stream.close()
+    finish()
+    return data
+
+def _postgres_exec(script, stdin=None, capture_stdout=False):
+    '''Run a shell script in the postgres container, exiting on failure'''
+    command = _compose_command(['exec', '-T', 'postgres', 'sh', '-c', script])
+    return _handle_err(_run(command, stdin=stdin, capture_stdout=capture_stdout))
+
+def _timed_phase(phases, name, func, *args):
+    print('  {}...'.format(name))
+    started = perf_counter()
+    result = func(*args)
+    phases.append((name, perf_counter() - started))
+    return result
+
+def _pg_restore(path, dump_format, database, user, jobs, analyze, phases):
+    '''Restore a pg_dump archive into a fresh database: schema first, then the data with `jobs` parallel
+    workers, then indexes, constraints and triggers (also in parallel) once the data is in'''
+    quote = shlex.quote
+    dest = '/tmp/hey-restore-{}'.format(os.getpid())
+    psql = 'psql -X -v ON_ERROR_STOP=1 -U {} '.format(quote(user))
+    _timed_phase(phases, 'recreate database', _postgres_exec, ' && '.join([
+        psql + '-d postgres -c {}'.format(quote(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{}' AND pid <> pg_backend_pid()"
+            .format(database.replace("'", "''")))),
+        'dropdb --if-exists -U {0} {1} && createdb -U {0} -O {0} {1}'.format(quote(user), quote(database))]))
+
+    if dump_format == 'directory':
+        copy = lambda: _handle_err(_run('tar -C {} -cf - . | {}'.format(quote(path), shlex.join(_compose_command(
+            ['exec', '-T', 'postgres', 'sh', '-c', 'mkdir -p {0} && tar -C {0} -xf -'.format(dest)]))), shell=True))
+    else:
+        def copy():
+            with open(path, 'rb') as stream:
+                _postgres_exec('cat > {}'.format(dest), stdin=stream)
+    _timed_phase(phases, 'copy archive', copy)
+
+    pg_restore = 'pg_restore -U {} -d {} {} '.format(quote(user), quote(database),
+                                                     ' '.join(CONFIG.get('pg_restore_args', ['--no-owner', '--no-acl'])))
+    try:
+        # A fresh database already has a public schema, which the archive may create again
+        _timed_phase(phases, 'schema', _postgres_exec, pg_restore + '--section=pre-data --clean --if-exists ' + dest)
+        _timed_phase(phases, 'data (-j {})'.format(jobs), _postgres_exec,
+                     pg_restore + '--section=data -j {} {}'.format(jobs, dest))
+        _timed_phase(phases, 'indexes and constraints (-j {})'.format(jobs), _postgres_exec,
+                     pg_restore + '--section=post-data -j {} {}'.format(jobs, dest))
+    finally:
+        _run(_compose_command(['exec', '-T', 'postgres', 'rm', '-rf', dest]), capture_stdout=True, echo_stderr=False)
+    if analyze:
+        _timed_phase(phases, 'analyze (-j {})'.format(jobs), _postgres_exec,
+                     'vacuumdb -U {} -d {} --analyze-only -j {}'.format(quote(user), quote(database), jobs))
+
+def _sanitize_database(database, user):
+    '''Apply restore_sanitize_sql (default SANITIZE_SQL) as one transaction that stops at the first error'''
+    sql = CONFIG.get('restore_sanitize_sql', SANITIZE_SQL).format(getpass.getuser())
+    result = _postgres_exec('psql -X -v ON_ERROR_STOP=1 --single-transaction -U {} -d {} <<\'HEY_SQL\'\n{}\nHEY_SQL'.format(
+        shlex.quote(user), shlex.quote(database), sql), capture_stdout=True)
+    for line in result.stdout.decode(errors='replace').splitlines():
+        print('    ' + line)
+
 @command
 def restore():
-    '''Restore the database from a tarfile in the work folder'''
+    '''Restore the database from a tarfile or pg_dump archive (--stream, -j N jobs, --analyze)'''
+    streaming = CONFIG.get('restore_streaming', False)
+    jobs = CONFIG.get('restore_jobs') or os.cpu_count() or 2
+    analyze = CONFIG.get('restore_analyze', False)
+    args = []
+    argv = iter(_args())
+    for arg in argv:
+        if arg == '--stream':
+            streaming = True
+        elif arg == '--analyze':
+            analyze = True
+        elif arg in ('-j', '--jobs'):
+            jobs = int(next(argv))
+        elif arg.startswith('--jobs='):
+            jobs = int(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
     dump = None
-    if not len(sys.argv) > 2:
-        dl = input("No file specified, would you like to download the latest prod backup? Y/n: ")
+    dump_dir = None
+    transport = None
+    if not args:
+        if streaming:
+            dl = input("No file specified, would you like to restore the latest prod backup? Y/n: ")
+        else:
+            dl = input("No file specified, would you like to download the latest prod backup? Y/n: ")
         if dl.lower() == 'n':
             return
+        elif streaming:
+            _go_to_working_dir()
+            transport = _backup_transport()
+            dump, size = transport.latest()
+            if CONFIG.get('backup_store_enabled', True):
+                with _backup_store() as store:
+                    stored = store.lookup(dump, size)
+                if stored:
+                    print('Restoring {} from the backup store'.format(dump))
+                    transport, dump = _LocalTransport(os.path.dirname(stored)), os.path.basename(stored)
+            if _peek(transport, dump, len(PG_DUMP_MAGIC)) == PG_DUMP_MAGIC:
+                # pg_restore -j needs to seek in the archive, so it can't be streamed
+                print('{} is a pg_dump archive, which is restored from a file rather than streamed'.format(dump))
+                streaming = False
+                if isinstance(transport, _LocalTransport):
+                    dump_dir = transport.directory
+                else:
+                    dump = getbackup()
         else:
             dump = getbackup()
 
-    print('Restoring database...')
-    _docker_compose(['stop'])
-
-    this_dir = os.path.dirname(os.path.realpath(__file__))
     wk_dir = _go_to_working_dir()
     if not dump:
-        dump = os.path.basename(sys.argv[2])
+        # normpath: tab completion leaves a trailing slash on a -Fd directory
+        dump = os.path.basename(os.path.normpath(args[0]))
+    dump_path = os.path.join(dump_dir or wk_dir, dump)
+    # A backup streamed from the backup host or store was already checked above
+    dump_format = None if streaming and transport else _dump_format(dump_path)
+    if streaming and dump_format:
+        # Same as for the latest backup above: pg_restore -j has to seek, so it gets the file instead
+        print('{} is a pg_dump archive, which is restored from a file rather than streamed'.format(dump))
+        streaming = False
+    # Anything else would reach the tarball branch, which empties the volume before extracting
+    if transport is None and not (os.path.isfile(dump_path) or dump_format == 'directory'):
+        print('There was a problem: {} is neither a file nor a pg_dump directory archive in {}'.format(dump, dump_dir or wk_dir))
+        sys.exit(1)
+
+    print('Restoring database...')
+    _docker_compose(['stop'])
 
     if 'data_volume_name' in CONFIG:
         volume_name = CONFIG['data_volume_name']
     else:
         volume_name = 'data'
 
-    print("Restoring data in container to wk_dir {}...".format(wk_dir))
-    _handle_err(_run_command(['docker', 'run', '--mount',
-        'type=bind,src={},destination=/pg_restore_src'.format(wk_dir), '--mount',
-        'type=volume,src={},destination=/pg_restore_dest'.format(volume_name), 'ubuntu', 'bash', '-c',
-            "cd /pg_restore_dest; \
-            echo '    Removing old data'; rm -R /pg_restore_dest/*; \
-            ls /pg_restore_src; \
-            echo '    Extracting backup data'; tar xfv /pg_restore_src/{}".format(dump)]))
+    if streaming:
+        print("Streaming {} into the {} volume...".format(dump, volume_name))
+        _stream_restore(volume_name, transport or _LocalTransport(wk_dir), dump)
+    elif dump_format:
+        print("{} is a pg_dump {} archive; restoring it with pg_restore once postgres is up".format(dump, dump_format))
+    else:
+        print("Restoring data in container to wk_dir {}...".format(wk_dir))
+        _handle_err(_run_command(['docker', 'run', '--mount',
+            'type=bind,src={},destination=/pg_restore_src'.format(wk_dir), '--mount',
+            'type=volume,src={},destination=/pg_restore_dest'.format(volume_name), 'ubuntu', 'bash', '-c',
+                "cd /pg_restore_dest; \
+                echo '    Removing old data'; rm -R /pg_restore_dest/*; \
+                ls /pg_restore_src; \
+                echo '    Extracting backup data'; tar xf /pg_restore_src/{}".format(dump)]))
 
     print('Stopping postgres...')
     _docker_compose(['up', '-d', 'postgres'])
 
     print('Cleaning up...')
-    r = None
-    output = str(getattr(r, 'stdout', ''))
-    database_name = 'argon'
-    database_user = 'argondb'
-    if 'services' in COMPOSE_FILE and 'postgres' in COMPOSE_FILE['services'] and 'environment' in COMPOSE_FILE['services']['postgres']:
-        env_vars = {k.split('=')[0]: k.split('=')[1] for k in COMPOSE_FILE['services']['postgres']['environment'] if '=' in k}
-        database_name = env_vars['POSTGRES_DB'] or 'argon'
-        database_user = env_vars['POSTGRES_USER'] or 'argondb'
-
-    print("Connecting to {} with {}".format(database_name, database_user))
-    while '(1 row)' not in output:
-        r = _docker_compose(['exec', 'postgres', 'bash', '-c',
-                             "psql -d {} -U {} -c 'select 1'".format(database_name, database_user)], handle_errors=False)
-        output = str(getattr(r, 'stdout', ''))
-        print(output)
-        sleep(1)
-
-    _docker_compose(['exec', '-d', 'postgres', 'bash', '-c', '''
-        psql -U argondb -d argon -c \"
-        UPDATE argon_users_user SET email='donotreply-{0}@aluminumtrailer.com' WHERE username='admin';
-        UPDATE argon_users_user SET email='{0}@aluminumtrailer.com' WHERE username='{0}';
-        UPDATE argon_users_user SET email='' WHERE username='trishz';
-
-        DELETE FROM argon_users_user_groups ug WHERE group_id=5;
-
-        INSERT INTO argon_users_user_groups (user_id, group_id)
-        SELECT u.id, 5
-        FROM argon_users_user u
-        WHERE username='{0}';
-
-        UPDATE argon_devices_device SET active=FALSE WHERE is_healthy=FALSE; \"'''.format(getpass.getuser())])
+    database_name, database_user = _pg_identity()
+
+    print("Waiting for {} to accept connections as {}...".format(database_name, database_user))
+    if not _wait_for_postgres(database_name, database_user):
+        print('Postgres did not come up within {} seconds.'.format(CONFIG.get('readiness_timeout', 120)))
+        sys.exit(1)
+
+    phases = []
+    if dump_format:
+        _pg_restore(dump_path, dump_format, database_name, database_user, jobs, analyze, phases)
+    _timed_phase(phases, 'sanitize', _sanitize_database, database_name, database_user)
+    if dump_format:
+        print('\nRestore phases:')
+        for name, seconds in phases:
+            print('  {:<34}{:>8.1f}s'.format(name, seconds))
+    if CONFIG.get('restore_snapshot'):
+        # Keep the freshly sanitized state around for `hey db reset`
+        _db_snapshot(CONFIG['restore_snapshot'])
 
     print('\nYour database has been restored!\n',
           'You can now re-start your containers. Remember to run migrations!', sep='')
 
 
+def _pg_identity():
+    '''(database, user) from the postgres service environment'''
+    env_vars = _service_environment('postgres')
+    return env_vars.get('POSTGRES_DB') or 'argon', env_vars.get('POSTGRES_USER') or 'argondb'
+
+def _pg_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def _pg_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+def _psql(user, sql, database='postgres'):
+    quote = shlex.quote
+    result = _postgres_exec('psql -X -v ON_ERROR_STOP=1 -At -U {} -d {} -c {}'.format(
+        quote(user), quote(database), quote(sql)), capture_stdout=True)
+    return result.stdout.decode(errors='replace').strip()
+
+def _disconnect(user, database):
+    _psql(user, 'SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity WHERE datname = {} AND pid <> pg_backend_pid()'
+          .format(_pg_literal(database)))
+
+def _copy_database(user, source, target):
+    '''CREATE DATABASE ... TEMPLATE, which copies the files server side. Postgres 15+ defaults to copying
+    through the WAL, which is much slower for a big database, so ask for FILE_COPY there.'''
+    strategy = ' STRATEGY = FILE_COPY' if int(_psql(user, 'SHOW server_version_num')) >= 150000 else ''
+    _disconnect(user, source)
+    _psql(user, 'CREATE DATABASE {} TEMPLATE {}{}'.format(_pg_ident(target), _pg_ident(source), strategy))
+    return int(_psql(user, 'SELECT pg_database_size({})'.format(_pg_literal(target))))
+
+def _drop_database(user, name):
+    _disconnect(user, name)
+    _psql(user, 'DROP DATABASE IF EXISTS {}'.format(_pg_ident(name)))
+
+def _copy_volume(source, target):
+    '''Replace the contents of volume `target` with those of `source`; returns the size copied'''
+    result = _run_command(['docker', 'run', '--rm', '--mount', 'type=volume,src={},destination=/from'.format(source),
+                           '--mount', 'type=volume,src={},destination=/to'.format(target), 'ubuntu', 'bash', '-c',
+                           'find /to -mindepth 1 -delete && cp -a /from/. /to/ && du -sb /to | cut -f1'],
+                          capture_stdout=True)
+    return int(result.stdout.split()[-1])
+
+def _db_snapshots_path():
+    return os.path.join(_cache_dir(), 'db_snapshots.json')
+
+def _snapshot_target(name, method):
+    if method == 'volume':
+        return '{}_hey_snap_{}'.format(CONFIG.get('data_volume_name', 'data'), name)
+    return 'hey_snap_{}'.format(name)
+
+def _drop_snapshot(info, user):
+    if info['method'] == 'volume':
+        _run_command(['docker', 'volume', 'rm', info['target']], capture_stdout=True)
+    else:
+        _drop_database(user, info['target'])
+
+def _evict_db_snapshots(snapshots, user, keep=()):
+    '''Drop the least recently used snapshots beyond db_snapshot_keep (default 5) or db_snapshot_max_gb'''
+    limit = CONFIG.get('db_snapshot_keep', 5)
+    max_bytes = CONFIG.get('db_snapshot_max_gb', 0) * 1024 ** 3
+    total, kept = 0, 0
+    for name, info in sorted(snapshots.items(), key=lambda item: -item[1]['last_used']):
+        if name not in keep and (kept >= limit or max_bytes and total + info['size'] > max_bytes):
+            print('Dropping snapshot {} ({})'.format(name, _human_bytes(info['size'])))
+            _drop_snapshot(info, user)
+            del snapshots[name]
+            continue
+        total += info['size']
+        kept += 1
+
+def _restart_postgres(database, user):
+    _docker_compose(['up', '-d', 'postgres'])
+    if not _wait_for_postgres(database, user):
+        print('Postgres did not come up within {} seconds.'.format(CONFIG.get('readiness_timeout', 120)))
+        sys.exit(1)
+
+def _db_snapshot(name, method=None):
+    '''Capture the database as a template database or a copy of the data volume'''
+    method = method or CONFIG.get('db_snapshot_method', 'template')
+    database, user = _pg_identity()
+    snapshots = _read_json(_db_snapshots_path(), {})
+    target = _snapshot_target(name, method)
+    if name in snapshots:
+        _drop_snapshot(snapshots.pop(name), user)
+    started = perf_counter()
+    print('Snapshotting {} as {} ({})...'.format(database, name, method))
+    if method == 'volume':
+        _docker_compose(['stop', 'postgres'])
+        size = _copy_volume(CONFIG.get('data_volume_name', 'data'), target)
+        _restart_postgres(database, user)
+    else:
+        size = _copy_database(user, database, target)
+    now = _lazy_import('time').time()
+    snapshots[name] = {'method': method, 'target': target, 'database': database, 'size': size,
+                       'created': now, 'last_used': now}
+    _evict_db_snapshots(snapshots, user, keep=[name])
+    _write_json(_db_snapshots_path(), snapshots)
+    print('Snapshot {} taken in {:.1f}s ({})'.format(name, perf_counter() - started, _human_bytes(size)))
+
+def _db_reset(name):
+    snapshots = _read_json(_db_snapshots_path(), {})
+    if name not in snapshots:
+        print('There was a problem: no snapshot named {}. Take one with `hey db snapshot {}`'.format(name, name))
+        sys.exit(1)
+    info = snapshots[name]
+    database, user = _pg_identity()
+    started = perf_counter()
+    print('Resetting {} to snapshot {}...'.format(database, name))
+    if info['method'] == 'volume':
+        _docker_compose(['stop', 'postgres'])
+        _copy_volume(info['target'], CONFIG.get('data_volume_name', 'data'))
+        _restart_postgres(database, user)
+    else:
+        # Copy first and swap by rename, so a failed copy leaves the current database alone
+        incoming = '{}_hey_incoming'.format(database)
+        _drop_database(user, incoming)
+        _copy_database(user, info['target'], incoming)
+        _drop_database(user, database)
+        _psql(user, 'ALTER DATABASE {} RENAME TO {}'.format(_pg_ident(incoming), _pg_ident(database)))
+    info['last_used'] = _lazy_import('time').time()
+    _write_json(_db_snapshots_path(), snapshots)
+    print('Reset to {} in {:.1f}s'.format(name, perf_counter() - started))
+
+@command(noninteractive=True)
+def db():
+    """Database snapshots: `hey db snapshot|reset|delete <name> [--volume]`, `hey db list`"""
+    args = [a for a in _args() if not a.startswith('--')]
+    method = 'volume' if '--volume' in _args() else 'template' if '--template' in _args() else None
+    action = args[0] if args else 'list'
+    name = args[1] if len(args) > 1 else 'default'
+    if not _lazy_import('re').match(r'^[A-Za-z0-9_-]+$', name):
+        print('There was a problem: snapshot names may only use letters, digits, _ and -')
+        sys.exit(1)
+    if action == 'snapshot':
+        _db_snapshot(name, method)
+    elif action == 'reset':
+        _db_reset(name)
+    elif action == 'delete':
+        snapshots = _read_json(_db_snapshots_path(), {})
+        if name in snapshots:
+            _drop_snapshot(snapshots.pop(name), _pg_identity()[1])
+            _write_json(_db_snapshots_path(), snapshots)
+        print('Snapshot {} deleted'.format(name))
+    elif action == 'list':
+        snapshots = _read_json(_db_snapshots_path(), {})
+        time = _lazy_import('time')
+        for name, info in sorted(snapshots.items(), key=lambda item: -item[1]['last_used']):
+            print('{:<20} {:<9} {:>10}  {}  {}'.format(name, info['method'], _human_bytes(info['size']),
+                                                      time.strftime('%Y-%m-%d %H:%M', time.localtime(info['created'])),
+                                                      info['database']))
+        print('{} snapshot(s), {}'.format(len(snapshots), _human_bytes(sum(i['size'] for i in snapshots.values()))))
+    else:
+        print('There was a problem: unknown action {}; use snapshot, reset, delete or list'.format(action))
+        sys.exit(1)
+
+
 @command
 def mkmigrations():
     '''Generate database migrations for schema changes'''
     print('Making migrations...')
     args = ''
-    if len(sys.argv) > 2:
-        args = ' '.join(sys.argv[2:])
+    if _args():
+        args = ' '.join(_args())
     _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
                      'python /code/django/manage.py makemigrations {}'.format(args)])
 
@@ -337,20 +2429,172 @@ def migrate():
     '''Apply migrations to the database'''
     print('Migrating...')
     args = ''
-    if len(sys.argv) > 2:
-        args = ' '.join(sys.argv[2:])
+    if _args():
+        args = ' '.join(_args())
     _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
                      'python /code/django/manage.py migrate {}'.format(args)])
 
 
+# Host files (relative to the config root) each cached build step reads; `build_inputs` in hey.yml overrides them
+BUILD_STEP_INPUTS = {
+    'jsbuild': {'inputs': ['django/js/**'], 'exclude': ['**/node_modules/**']},
+    'collectstatic': {'inputs': ['django/**/static/**'], 'exclude': ['**/node_modules/**']},
+}
+
+def _build_cache_dir():
+    return os.path.join(_cache_dir(), 'build_cache')
+
+def _step_inputs(step):
+    '''Every file matching the step's input globs, walking only below each glob's fixed prefix and never
+    into excluded directories'''
+    fnmatch = _lazy_import('fnmatch').fnmatch
+    spec = dict(BUILD_STEP_INPUTS.get(step, {}))
+    spec.update(CONFIG.get('build_inputs', {}).get(step) or {})
+    excludes = spec.get('exclude', [])
+    paths = set()
+    for pattern in spec.get('inputs', []):
+        fixed = []
+        for part in pattern.split('/'):
+            if any(c in part for c in '*?['):
+                break
+            fixed.append(part)
+        base = '/'.join(fixed) or '.'
+        if os.path.isfile(base):
+            paths.add(base)
+            continue
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = [d for d in dirnames
+                           if not any(fnmatch(os.path.join(dirpath, d) + '/', e) for e in excludes)]
+            for filename in filenames:
+                path = os.path.normpath(os.path.join(dirpath, filename))
+                if fnmatch(path, pattern) and not any(fnmatch(path, e) for e in excludes):
+                    paths.add(path)
+    return sorted(paths)
+
+def _fingerprint(paths, previous):
+    '''{path: [mtime_ns, size, content hash]}. Files whose mtime and size match `previous` keep their old
+    hash, so only new or touched files are read. Returns it with the number of files hashed.'''
+    files, hashed = {}, 0
+    for path in paths:
+        key = _stat_key(path)
+        if key is None:
+            continue
+        entry = previous.get(path)
+        if entry and entry[:2] == key:
+            files[path] = entry
+            continue
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(1 << 20), b''):
+                digest.update(chunk)
+        files[path] = key + [digest.hexdigest()]
+        hashed += 1
+    return files, hashed
+
+def _cached_step(step, run, key='', force=False):
+    '''Run a build step unless its inputs (and key, e.g. its arguments) are the same as after it last succeeded.
+    The manifest is taken after the step runs, so outputs that land among the inputs don't count as changes.'''
+    manifest_path = os.path.join(_build_cache_dir(), step + '.json')
+    manifest = _read_json(manifest_path, {})
+    previous = manifest.get('files', {}) if manifest.get('key') == key else {}
+    started = perf_counter()
+    files, hashed = _fingerprint(_step_inputs(step), previous)
+    unchanged = bool(previous) and {p: e[2] for p, e in files.items()} == {p: e[2] for p, e in previous.items()}
+    stats_path = os.path.join(_build_cache_dir(), 'stats.json')
+    if unchanged and not force:
+        print('{}: {} input file(s) unchanged ({} hashed in {:.2f}s), skipping it'.format(
+            step, len(files), hashed, perf_counter() - started))
+        if hashed:
+            manifest['files'] = files
+            _write_json(manifest_path, manifest)
+        outcome, saved = 'hits', manifest.get('seconds', 0)
+    else:
+        print('{}: {}'.format(step, 'forced' if unchanged else 'inputs changed' if previous else 'no manifest yet'))
+        run_started = perf_counter()
+        run()
+        seconds = perf_counter() - run_started
+        files, _ = _fingerprint(_step_inputs(step), files)
+        _write_json(manifest_path, {'key': key, 'files': files, 'seconds': seconds})
+        outcome, saved = 'misses', 0
+    stats = _read_json(stats_path, {})
+    step_stats = stats.setdefault(step, {'hits': 0, 'misses': 0, 'saved': 0})
+    step_stats[outcome] += 1
+    step_stats['saved'] += saved
+    _write_json(stats_path, stats)
+    print('{} cache: {} hit(s), {} miss(es), ~{:.0f}s saved so far'.format(
+        step, step_stats['hits'], step_stats['misses'], step_stats['saved']))
+
+@command(noninteractive=True)
+def buildcache():
+    """Show hit/miss stats for jsbuild and collectstatic (`clear` forgets every manifest)"""
+    if _args()[:1] == ['clear']:
+        _lazy_import('shutil').rmtree(_build_cache_dir(), ignore_errors=True)
+        print('Build cache cleared')
+        return
+    stats = _read_json(os.path.join(_build_cache_dir(), 'stats.json'), {})
+    if not stats:
+        print('No cached build steps have run yet')
+    for step, step_stats in sorted(stats.items()):
+        print('{:<16} {:>5} hit(s) {:>5} miss(es)  ~{:.0f}s saved'.format(
+            step, step_stats['hits'], step_stats['misses'], step_stats['saved']))
+
+def _percentile(values, percent):
+    '''Nearest-rank percentile of sorted values'''
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 60:
+        return '{:.2f}s'.format(seconds)
+    return '{:.0f}m{:02.0f}s'.format(*divmod(seconds, 60))
+
+@command(noninteractive=True)
+def stats():
+    """Wall time p50/p95 per command and subprocess from the timing log (`hey stats DAYS` for recent runs)"""
+    days = float(_args()[0]) if _args() else None
+    cutoff = _lazy_import('time').time() - days * 86400 if days else 0
+    groups = {}
+    for path in [_timing_log_path() + '.1', _timing_log_path()]:
+        try:
+            with open(path, 'r') as stream:
+                for line in stream:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['at'] >= cutoff:
+                        groups.setdefault((record['kind'], record['name']), []).append(record)
+        except OSError:
+            pass
+    if not groups:
+        print('No timings recorded yet ({})'.format(_timing_log_path()))
+        return
+    for kind in ['command', 'process']:
+        names = sorted(name for k, name in groups if k == kind)
+        if not names:
+            continue
+        width = max(len(n) for n in names + [kind])
+        print('\n{:<{}}  {:>5}  {:>8}  {:>8}  {:>8}  {:>8}  {:>5}  {:>8}  {:>9}'.format(
+            kind, width, 'runs', 'p50', 'p95', 'max', 'last', 'fail', 'ttfo p50', 'out p50'))
+        for name in names:
+            records = groups[(kind, name)]
+            walls = sorted(r['wall'] for r in records)
+            first_outputs = sorted(r['ttfo'] for r in records if r['ttfo'] is not None)
+            print('{:<{}}  {:>5}  {:>8}  {:>8}  {:>8}  {:>8}  {:>5}  {:>8}  {:>9}'.format(
+                name, width, len(records), _format_seconds(_percentile(walls, 50)),
+                _format_seconds(_percentile(walls, 95)), _format_seconds(walls[-1]),
+                _format_seconds(records[-1]['wall']), sum(1 for r in records if r['exit']),
+                _format_seconds(_percentile(first_outputs, 50) if first_outputs else None),
+                _human_bytes(_percentile(sorted(r['bytes'] for r in records), 50))))
+
 @command
 def jsbuild():
-    '''Run a webpack build'''
-    args = ''
-    if len(sys.argv) > 2:
-        args = ' '.join(sys.argv[2:])
-    _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
-                     'cd /code/django/js; npm run build {}'.format(args)])
+    '''Run a webpack build (skipped if nothing under django/js changed; --force runs it anyway)'''
+    args = [a for a in _args() if a != '--force']
+    _cached_step('jsbuild', lambda: _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
+                                                      'cd /code/django/js; npm run build {}'.format(' '.join(args))]),
+                 key=' '.join(args), force='--force' in _args())
 
 
 @command
@@ -369,9 +2613,9 @@ def jswatch():
 @command
 def npm():
     '''Run arbitrary npm commands in the container'''
-    if len(sys.argv) > 2:
+    if _args():
         _docker_compose(['exec', CONFIG.get('default_container', 'django'), 'bash', '-c',
-                         'cd /code/django/js; npm {}'.format(' '.join(sys.argv[2:]))])
+                         'cd /code/django/js; npm {}'.format(' '.join(_args()))])
 
 
 def _manage_py(command):
@@ -380,10 +2624,10 @@ def _manage_py(command):
 
 @command
 def collectstatic():
-    '''Copy all static assets to argon/static'''
-    _manage_py('collectstatic --no-input')
+    '''Copy all static assets to argon/static (skipped if no static files changed; --force runs it anyway)'''
+    _cached_step('collectstatic', lambda: _manage_py('collectstatic --no-input'), force='--force' in _args())
 
-@command
+@command(needs_config=False)
 def alias():
     '''Learn how to set up an alias for this script'''
     print(r'''Alias setup
@@ -397,7 +2641,7 @@ On linux/macOS add this to your bash profile:
     alias hey="python /path/to/scripts/hey_helpers.py"
 ''')
 
-@command
+@command(needs_config=False)
 def pubkey():
     '''Learn how to get backup files without password prompts'''
     print('''
@@ -417,33 +2661,131 @@ Note: you may have to create the files named here if they don't exist
 Now you should be able to run `hey getbackup` and have it work automagically
 ''')
 
+GKE_CLUSTER = 'cluster-habitdb'
+# (image name, build context) build/pushtogke handle when hey.yml lists no `images`
+GKE_IMAGES = [('gcr.io/habitdb/habitdb-www', '.'), ('gcr.io/habitdb/kanbanflow_sync', 'kanbanflow_sync')]
+CLIENT_SECRET = 'client_secret_712322130843-pi61a3cagb4ic94d5pep77n5tpv4dmf1.apps.googleusercontent.com.json'
+
+def _has_gke_credentials():
+    cmd = _run(['kubectl', 'config', 'current-context'], capture_stdout=True, echo_stderr=False)
+    return cmd.returncode == 0 and cmd.stdout.decode().strip().endswith('_' + GKE_CLUSTER)
+
+@task('credentials', up_to_date=_has_gke_credentials)
+def _getcredentials():
+    command = ['gcloud', 'container', 'clusters', 'get-credentials', '--zone', 'us-central1-f', '--project', 'habitdb', GKE_CLUSTER]
+    return _run_command(command)
+
+@task('client-secret', deps=['credentials'], up_to_date=lambda: os.path.isfile(os.path.join('app', CLIENT_SECRET)))
+def _copyclientsecret():
+    command = [get_scp_command(), 'jake@hephaestus:/home/jake/Src/secrets/{}'.format(CLIENT_SECRET), './app/']
+    return _run_command(command)
+
 @command(command_name='get-credentials')
 def getcredentials():
     '''Get google cloud kubernetes credentials'''
-    command = ['gcloud', 'container', 'clusters', 'get-credentials', '--zone', 'us-central1-f', '--project', 'habitdb', 'cluster-habitdb']
-    return _run_command(command)
+    return _getcredentials()
 
 @command
 def copyclientsecret():
     '''Copies client secret TODO improve this'''
-    getcredentials()
-    command = [get_scp_command(), 'jake@hephaestus:/home/jake/Src/secrets/client_secret_712322130843-pi61a3cagb4ic94d5pep77n5tpv4dmf1.apps.googleusercontent.com.json', './app/']
-    return _run_command(command)
-
-@command
-def build():
-    '''Build docker images'''
-    copyclientsecret()
-    # TODO determine names based on configuration or directory context
-    tag = _kubegetnexttag('gcr.io/habitdb/habitdb-www')
-    habitdb_www_build_command = ['docker', 'build', '-t', tag, '.']
-    _run_command(habitdb_www_build_command)
-    tag = _kubegetnexttag('gcr.io/habitdb/kanbanflow_sync')
-    kanbanflow_sync_build_command = ['docker', 'build', '-t', tag, 'kanbanflow_sync']
-    return _run_command(kanbanflow_sync_build_command)
-
-def _pushtogke(image_name):
-    tag = _kubegetnexttag(image_name)
+    _run_tasks(['credentials'])
+    return _copyclientsecret()
+
+def _image_exists(tag):
+    return _run(['docker', 'image', 'inspect', tag], capture_stdout=True, echo_stderr=False).returncode == 0
+
+def _image_specs():
+    '''The images build/pushtogke handle: `images` in hey.yml, each like
+        {name, context, dockerfile, tag: registry|git|<literal>, build_args, cache_from, depends_on}
+    or GKE_IMAGES when that isn't set. depends_on names other images (by short name) or tasks.'''
+    configured = CONFIG.get('images')
+    if not configured:
+        return [{'name': name, 'context': context, 'tag': 'registry', 'depends_on': ['client-secret']}
+                for name, context in GKE_IMAGES]
+    return [dict({'context': '.', 'tag': 'registry', 'depends_on': []}, **spec) for spec in configured]
+
+_GIT_SHAS = {}
+
+def _image_tag(spec):
+    '''The tag this run builds and pushes: the next registry version, the context's git commit or a fixed tag'''
+    if spec['tag'] == 'registry':
+        return _kubegetnexttag(spec['name'])
+    if spec['tag'] == 'git':
+        context = os.path.realpath(spec['context'])
+        if context not in _GIT_SHAS:
+            result = _handle_err(_run(['git', 'rev-parse', '--short', 'HEAD'], capture_stdout=True, cwd=context))
+            _GIT_SHAS[context] = result.stdout.decode().strip()
+        return '{}:{}'.format(spec['name'], _GIT_SHAS[context])
+    return '{}:{}'.format(spec['name'], spec['tag'])
+
+def _build_history_path():
+    return os.path.join(_cache_dir(), 'build_history.json')
+
+def _cache_from(spec):
+    '''Images to reuse layers from: any configured, then the previous version (or the last build here)'''
+    refs = list(spec.get('cache_from') or [])
+    if spec['tag'] == 'registry' and _kubegetlatesttagarray(spec['name']):
+        refs.append('{}:{}'.format(spec['name'], _kubegetlatesttag(spec['name'])))
+    else:
+        previous = _read_json(_build_history_path(), {}).get(spec['name'], {}).get('tag')
+        if previous:
+            refs.append(previous)
+    return [ref for i, ref in enumerate(refs) if ref not in refs[:i] and ref != _image_tag(spec)]
+
+def _dockerignore(context):
+    try:
+        with open(os.path.join(context, '.dockerignore'), 'r') as stream:
+            lines = [line.strip() for line in stream]
+    except OSError:
+        return []
+    # Exceptions (!pattern) are rare enough that the size estimate ignores them
+    return [line.strip('/') for line in lines if line and not line.startswith(('#', '!'))]
+
+def _context_size(context):
+    '''Roughly what `docker build` sends as the context: every file not excluded by .dockerignore'''
+    fnmatch = _lazy_import('fnmatch').fnmatch
+    ignored = _dockerignore(context)
+    def excluded(path):
+        return any(fnmatch(path, p) or fnmatch(path, '**/' + p) for p in ignored)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(context):
+        relative = os.path.relpath(dirpath, context)
+        prefix = '' if relative == '.' else relative + '/'
+        dirnames[:] = [d for d in dirnames if not excluded(prefix + d)]
+        for filename in filenames:
+            if not excluded(prefix + filename):
+                total += (_stat_key(os.path.join(dirpath, filename)) or [0, 0])[1]
+    return total
+
+_BUILD_SLOTS = {}
+
+def _build_image(spec):
+    tag = _image_tag(spec)
+    command = ['docker', 'build', '-t', tag]
+    if spec.get('dockerfile'):
+        command += ['-f', os.path.join(spec['context'], spec['dockerfile'])]
+    for key, value in sorted((spec.get('build_args') or {}).items()):
+        command += ['--build-arg', '{}={}'.format(key, value)]
+    for ref in _cache_from(spec):
+        command += ['--cache-from', ref]
+    # Lets the image we push now serve as --cache-from for the next build under BuildKit
+    command += ['--build-arg', 'BUILDKIT_INLINE_CACHE=1', spec['context']]
+    context_bytes = _context_size(spec['context'])
+    slots = _BUILD_SLOTS.setdefault('slots', threading.BoundedSemaphore(max(1, CONFIG.get('build_parallel', 2))))
+    with slots:
+        started = perf_counter()
+        _run_command(command)
+        seconds = perf_counter() - started
+    with _tag_lock('build history'):
+        history = _read_json(_build_history_path(), {})
+        history[spec['name']] = {'tag': tag, 'seconds': round(seconds, 1), 'context_bytes': context_bytes,
+                                 'finished': _lazy_import('time').time()}
+        _write_json(_build_history_path(), history)
+    print('Built {} in {:.1f}s ({} context)'.format(tag, seconds, _human_bytes(context_bytes)))
+
+def _pushtogke(spec):
+    image_name = spec['name']
+    tag = _image_tag(spec)
     push_command = ['docker', 'push', tag]
     _run_command(push_command)
     prodtag = '{}:prod'.format(image_name)
@@ -451,84 +2793,306 @@ def _pushtogke(image_name):
     _run_command(tag_command)
     push_prod_command = ['docker', 'push', prodtag]
     _run_command(push_prod_command)
+    if spec['tag'] == 'registry':
+        # Later lookups (the next run, or the next command in a batch) must not hand out the tag just pushed
+        pushed = _next_tag_array(image_name)
+        _write_tag_cache(image_name, pushed)
+        with _tag_lock(image_name):
+            _TAGS[image_name] = pushed
+
+def _short_image_name(image_name):
+    return image_name.rsplit('/', 1)[-1]
+
+def _build_deps(spec, short_names):
+    deps = ['tags'] if spec['tag'] == 'registry' else []
+    return deps + ['build:' + d if d in short_names else d for d in spec['depends_on']]
+
+def _image_tasks():
+    '''Register the build/push tasks of every image (see _image_specs), plus `tags` and `apply`'''
+    specs = _image_specs()
+    short_names = [_short_image_name(spec['name']) for spec in specs]
+    for spec, short_name in zip(specs, short_names):
+        # Re-running after a failed push shouldn't rebuild an image that already carries its tag. Only a
+        # registry tag is new for every build; a fixed or git tag can name an image built from other inputs.
+        up_to_date = (lambda spec=spec: _image_exists(_image_tag(spec))) if spec['tag'] == 'registry' else None
+        task('build:' + short_name, deps=_build_deps(spec, short_names),
+             up_to_date=up_to_date)(lambda spec=spec: _build_image(spec))
+        task('push:' + short_name, deps=['build:' + short_name])(lambda spec=spec: _pushtogke(spec))
+    task('tags')(lambda: _resolve_tags([s['name'] for s in specs if s['tag'] == 'registry']))
+    # kubectl apply must talk to our cluster, whatever the images depend on
+    task('apply', deps=['credentials'] + ['push:' + name for name in short_names])(_applygkeconfig)
+    for spec in specs:
+        unknown = [d for d in spec['depends_on'] if d not in short_names and d not in TASKS]
+        if unknown:
+            print('There was a problem: unknown dependency {} of {}; images: {}; tasks: {}'.format(
+                ', '.join(unknown), spec['name'], ', '.join(short_names),
+                ', '.join(t for t in TASKS if ':' not in t)))
+            sys.exit(1)
+    return specs
+
+def _applygkeconfig():
+    apply_habitdb_command = ['kubectl', 'apply', '-f', 'deployment/kubernetes/www.yaml']
+    _run_command(apply_habitdb_command)
+
+def _print_build_plan(specs, targets):
+    '''What `hey build` would do, in waves of images that can build at the same time'''
+    short_names = [_short_image_name(spec['name']) for spec in specs]
+    by_task = {'build:' + name: spec for name, spec in zip(short_names, specs)}
+    history = _read_json(_build_history_path(), {})
+    waves = {}
+    for name in _task_order(targets):
+        if name in by_task:
+            deps = [d for d in TASKS[name]['deps'] if d in by_task]
+            waves[name] = 1 + max([waves[d] for d in deps] or [0])
+    print('Build plan ({} at a time):'.format(CONFIG.get('build_parallel', 2)))
+    for wave in sorted(set(waves.values())):
+        print('\nWave {}:'.format(wave))
+        for name in [n for n, w in waves.items() if w == wave]:
+            spec = by_task[name]
+            last = history.get(spec['name'])
+            print('  {}'.format(_image_tag(spec)))
+            print('    context      {} ({})'.format(spec['context'], _human_bytes(_context_size(spec['context']))))
+            print('    dockerfile   {}'.format(os.path.join(spec['context'], spec.get('dockerfile') or 'Dockerfile')))
+            print('    cache from   {}'.format(', '.join(_cache_from(spec)) or '-'))
+            print('    depends on   {}'.format(', '.join(TASKS[name]['deps']) or '-'))
+            if spec.get('build_args'):
+                print('    build args   {}'.format(', '.join(sorted(spec['build_args']))))
+            if last:
+                print('    last build   {:.1f}s ({})'.format(last['seconds'], last['tag']))
+
+@command
+def build():
+    '''Build docker images (`--dry-run` prints the plan; name images to build only those)'''
+    specs = _image_tasks()
+    args = [a for a in _args() if a != '--dry-run']
+    short_names = [_short_image_name(spec['name']) for spec in specs]
+    unknown = [a for a in args if a not in short_names]
+    if unknown:
+        print('There was a problem: unknown image(s) {}; configured: {}'.format(', '.join(unknown), ', '.join(short_names)))
+        sys.exit(1)
+    targets = ['build:' + name for name in args or short_names]
+    if '--dry-run' in _args():
+        _print_build_plan(specs, targets)
+    else:
+        _run_tasks(targets)
 
 @command
 def pushtogke():
     '''Push docker images to google kubernetes cloud'''
-    # TODO only run prerequisites if they aren't met
-    build()
-    image_name = 'gcr.io/habitdb/habitdb-www'
-    _pushtogke(image_name)
-
-    image_name = 'gcr.io/habitdb/kanbanflow_sync'
-    _pushtogke(image_name)
+    _run_tasks(['push:' + _short_image_name(spec['name']) for spec in _image_tasks()])
 
 @command
 def applygkeconfig():
     '''Apply updates to google kubernetes engine in the cloud'''
-    # TODO only run prerequisites if they aren't met
-    pushtogke()
-    apply_habitdb_command = ['kubectl', 'apply', '-f', 'deployment/kubernetes/www.yaml']
-    _run_command(apply_habitdb_command)
+    _image_tasks()
+    _run_tasks(['apply'])
+
+# (selector, running_only) -> (perf_counter(), pods), so a batch or the REPL doesn't ask kubectl every time
+_PODS = {}
+
+def _kube_pods(selector, running_only=False):
+    '''Pods matching a label selector from one `kubectl get -o json`, running ones first. The answer is
+    reused for `kube_pod_cache_seconds` (default 30) within one process.'''
+    cached = _PODS.get((selector, running_only))
+    if cached and perf_counter() - cached[0] < CONFIG.get('kube_pod_cache_seconds', 30):
+        return list(cached[1])
+    result = _run_command(['kubectl', 'get', 'pods', '-l', selector, '-o', 'json'], capture_stdout=True)
+    items = json.loads(result.stdout.decode('utf-8', errors='ignore') or '{}').get('items', [])
+    def running(item):
+        return item.get('status', {}).get('phase') == 'Running' and not item['metadata'].get('deletionTimestamp')
+    if running_only:
+        items = [i for i in items if running(i)]
+    pods = [i['metadata']['name'] for i in sorted(items, key=lambda i: not running(i))]
+    _PODS[(selector, running_only)] = (perf_counter(), pods)
+    return list(pods)
+
+def _kube_options(args):
+    '''Split leading `--all`, `-l/--selector S` and `--parallel N` off a kubeexec/kubelogs argument list'''
+    options = {'all': False, 'selector': CONFIG.get('kube_selector', 'name=www'),
+               'parallel': CONFIG.get('kube_parallel', 8)}
+    args = list(args)
+    while args and args[0].startswith('-'):
+        opt = args.pop(0)
+        name, _, value = opt.partition('=')
+        if opt == '--all':
+            options['all'] = True
+        elif name in ('-l', '--selector'):
+            options['selector'] = value or args.pop(0)
+        elif name == '--parallel':
+            options['parallel'] = int(value or args.pop(0))
+        else:
+            args.insert(0, opt)
+            break
+    return options, args
+
+async def _run_prefixed(prefix, width, command, semaphore, out, cwd=None):
+    '''Run a child with its output merged and each line prefixed; returns (prefix, exit code, seconds)'''
+    async with semaphore:
+        started = perf_counter()
+        proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, cwd=cwd,
+                                                    stderr=asyncio.subprocess.STDOUT, stdin=asyncio.subprocess.DEVNULL)
+        label = '{:<{}} | '.format(prefix, width).encode()
+        returncode, output_bytes, first_output = -1, 0, None
+        try:
+            async for line in _read_lines(proc.stdout):
+                output_bytes += len(line)
+                first_output = first_output or perf_counter()
+                out.write(label + (line if line.endswith(b'\n') else line + b'\n'))
+                out.flush()
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            await _terminate(proc)
+            raise
+        finally:
+            _record_timing('process', _timing_name(command), started, returncode, output_bytes, first_output)
+        return prefix, returncode, perf_counter() - started
+
+def _fan_out(commands, parallel, label='pod', exit_on_failure=True, cwds=None):
+    '''Run {prefix: command} (in {prefix: directory} if given) with at most `parallel` at a time,
+    then print a summary table'''
+    out = _binary_stream(sys.stdout) or sys.stdout
+    width = max(len(p) for p in list(commands) + [label])
+    sys.stdout.flush()
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, parallel))
+        return await asyncio.gather(*[_run_prefixed(p, width, c, semaphore, out, (cwds or {}).get(p))
+                                      for p, c in commands.items()])
+    try:
+        results = asyncio.run(run_all())
+    except KeyboardInterrupt:
+        print('\nInterrupted')
+        sys.exit(130)
+    print('\n{:<{}}  {:>4}  {:>8}'.format(label, width, 'exit', 'time'))
+    for prefix, returncode, seconds in results:
+        print('{:<{}}  {:>4}  {:>7.1f}s'.format(prefix, width, returncode, seconds))
+    failed = [r for r in results if r[1] != 0]
+    print('{}/{} succeeded'.format(len(results) - len(failed), len(results)))
+    if failed and exit_on_failure:
+        sys.exit(1)
+    return results
+
+def _fan_out_pods(options):
+    pods = _kube_pods(options['selector'], running_only=True)
+    if not pods:
+        print('No running pods match {}'.format(options['selector']))
+        sys.exit(1)
+    print('{} running pod(s) match {}'.format(len(pods), options['selector']))
+    return pods
 
 @command
 def getpodname():
     '''Get the detailed pod name by label'''
-    get_pod_name_command = ['kubectl', 'get', 'pods', '-l', 'name=www', "-o=jsonpath='{.items[].metadata.name}'"]
-    result = _run_command(get_pod_name_command, stdout=subprocess.PIPE)
-    podname = result.stdout.decode("utf-8", errors='ignore').replace("'", "")
+    pods = _kube_pods(CONFIG.get('kube_selector', 'name=www'))
+    podname = pods[0] if pods else ''
     print(podname)
     return podname
 
 @command
 def kubelogs():
-    '''Get the logs for a given container'''
-    podname = getpodname()
-    if not len(sys.argv) > 2:
+    '''Get the logs for a given container (--all: every matching pod, -l to pick the selector)'''
+    options, args = _kube_options(_args())
+    if not args:
         print("Error: container name required")
         return
 
-    args = sys.argv[2:]
     containername = args[0]
+    if options['all']:
+        pods = _fan_out_pods(options)
+        return _fan_out({pod: ['kubectl', 'logs', pod, '-c', containername] + args[1:] for pod in pods},
+                        options['parallel'])
+    podname = getpodname()
     kubectl_logs_command = ['kubectl', 'logs', podname, '-c', containername]
     _run_command(kubectl_logs_command)
 
 @command
 def kubeexec():
-    '''Exec in a given container'''
-    podname = getpodname()
-    if not len(sys.argv) > 3:
+    '''Exec in a given container (--all: every matching pod, -l to pick the selector)'''
+    options, args = _kube_options(_args())
+    if not len(args) > 1:
         print("Error: container name and command required")
         return
 
-    args = sys.argv[2:]
     containername = args[0]
     exec_command = args[1:]
+    if options['all']:
+        pods = _fan_out_pods(options)
+        return _fan_out({pod: ['kubectl', 'exec', pod, '-c', containername, '--'] + exec_command for pod in pods},
+                        options['parallel'])
+    podname = getpodname()
     kubectl_exec_command = ['kubectl', 'exec', '-it', podname, '-c', containername, '--'] + exec_command
     _run_command(kubectl_exec_command)
 
 @command
 def kubegettags():
     '''Get the current tags for a given image'''
-    if not len(sys.argv) > 2:
+    if not _args():
         print("Error: image name required")
         return
 
-    args = sys.argv[2:]
+    args = _args()
     image_name = args[0]
     list_tags_command = ['gcloud', 'container', 'images', 'list-tags', image_name]
     _run_command(list_tags_command)
 
-def _kubegetlatesttagarray(image_name):
-    list_tags_command = ['gcloud', 'container', 'images', 'list-tags', image_name, '--limit=1', '--format=value(tags[])']
-    result = _run_command(list_tags_command, stdout=subprocess.PIPE)
-    latesttags = result.stdout.decode("utf-8", errors='ignore').replace("'", "").split(';')
+# Latest tag array per image, looked up once per run (see _kubegetlatesttagarray)
+_TAGS = {}
+_TAG_LOCKS = {}
+
+def _tag_lock(key):
+    # setdefault is atomic, so concurrent callers always share one lock per key
+    return _TAG_LOCKS.setdefault(key, threading.Lock())
+
+def _parse_tag_array(output):
+    '''Highest version in `gcloud ... list-tags --format=value(tags[])` output, e.g. "v1.2.3;latest" -> [1, 2, 3].
+    [] when no tag looks like a version (an image only tagged "latest", or none at all).'''
     split_tags = []
-    for tag in latesttags:
-        tag_values = [int(i) for i in tag.replace('v', '').split('.') if i.isdigit()]
-        split_tags.append(tag_values)
-    split_tags = list(sorted(split_tags, reverse=True))
-    return split_tags[0]
+    for tag in output.replace("'", "").replace('\n', ';').split(';'):
+        tag_values = [int(i) for i in tag.strip().replace('v', '').split('.') if i.isdigit()]
+        if tag_values:
+            split_tags.append(tag_values)
+    return max(split_tags) if split_tags else []
+
+def _tag_cache_path():
+    return os.path.join(_cache_dir(), 'tags.json')
+
+def _read_tag_cache():
+    return _read_json(_tag_cache_path(), {})
+
+def _write_tag_cache(image_name, tag_array):
+    '''Remember a tag array for `tag_cache_ttl` seconds across runs (off unless that is set in hey.yml)'''
+    if not CONFIG.get('tag_cache_ttl'):
+        return
+    with _tag_lock(None):
+        cache = _read_tag_cache()
+        cache[image_name] = [_lazy_import('time').time(), tag_array]
+        _write_json(_tag_cache_path(), cache)
+
+def _cached_tag_array(image_name):
+    ttl = CONFIG.get('tag_cache_ttl')
+    entry = _read_tag_cache().get(image_name) if ttl else None
+    if entry and _lazy_import('time').time() - entry[0] < ttl:
+        return entry[1]
+    return None
+
+def _kubegetlatesttagarray(image_name):
+    '''Latest version tag of an image. The registry is asked once per image per run, so every
+    step of a pipeline agrees on the "next" tag even if someone else pushes in between.'''
+    with _tag_lock(image_name):
+        if image_name not in _TAGS:
+            tag_array = _cached_tag_array(image_name)
+            if tag_array is None:
+                list_tags_command = ['gcloud', 'container', 'images', 'list-tags', image_name, '--limit=1', '--format=value(tags[])']
+                result = _run_command(list_tags_command, capture_stdout=True)
+                tag_array = _parse_tag_array(result.stdout.decode("utf-8", errors='ignore'))
+                _write_tag_cache(image_name, tag_array)
+            _TAGS[image_name] = tag_array
+    return list(_TAGS[image_name])
+
+def _resolve_tags(image_names):
+    '''Look up the latest tags of several images at once'''
+    futures = _lazy_import('concurrent.futures')
+    with futures.ThreadPoolExecutor(max_workers=max(1, len(image_names))) as pool:
+        return dict(zip(image_names, pool.map(_kubegetlatesttagarray, image_names)))
 
 def _kubegetlatesttag(image_name):
     tag_array = _kubegetlatesttagarray(image_name)
@@ -536,20 +3100,24 @@ def _kubegetlatesttag(image_name):
     # print(latest_tag)
     return latest_tag
 
-def _kubegetnexttag(image_name):
-    tag_array = _kubegetlatesttagarray(image_name)
+def _next_tag_array(image_name):
+    # An image without version tags yet gets v0.0.1
+    tag_array = _kubegetlatesttagarray(image_name) or [0, 0, 0]
     tag_array[-1] += 1
-    next_tag = "v" + ".".join([str(i) for i in tag_array])
+    return tag_array
+
+def _kubegetnexttag(image_name):
+    next_tag = "v" + ".".join([str(i) for i in _next_tag_array(image_name)])
     return "{}:{}".format(image_name, next_tag)
 
 @command
 def kubegetlatesttag():
     '''Get the latest tag for a given image'''
-    if not len(sys.argv) > 2:
+    if not _args():
         print("Error: image name required")
         return
 
-    args = sys.argv[2:]
+    args = _args()
     image_name = args[0]
     _kubegetlatesttag(image_name)
 
@@ -583,6 +3151,8 @@ def welcome():
               __/ |
              |___/
 ''')
+    _go_to_working_dir()
+    _load_plugins()
     for i, k in enumerate(COMMANDS.keys()):
         sep = '\t'
         if len(k) > 11: sep = ''
@@ -592,18 +3162,641 @@ def welcome():
     for k in NONINTERACTIVE.keys():
         print('{} \t {}'.format(k, getattr(NONINTERACTIVE[k], '__doc__') or 'Needs docstring'))
 
-    choice = None
-    while not choice or choice.lower() != 'q' and not _command_match(choice):
-        choice = input("\nType a number, a command, or `q` to quit: ")
+    choice = []
+    while not choice or choice[0].lower() != 'q' and not _command_match(choice[0], args=choice[1:]):
+        try:
+            choice = shlex.split(input("\nType a number, a command (with its arguments), or `q` to quit: "))
+        except ValueError as e:
+            print('There was a problem: {}'.format(e))
+            choice = []
+
+def _edit_distance(a, b, limit):
+    '''Levenshtein distance of a and b, or limit + 1 as soon as it is known to exceed limit'''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class _CommandIndex:
+    '''Every registered command, indexed for lookup: case-folded names, sorted names for
+    short_commands prefix search and the stable numbers welcome() shows'''
+    def __init__(self, commands, numbered):
+        self.commands = dict(commands)
+        self.numbered = list(numbered)
+        self.folded = {}
+        for name in self.commands:
+            self.folded.setdefault(name.casefold(), []).append(name)
+        self.sorted = None
+
+    def __getitem__(self, name):
+        return self.commands[name]
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def keys(self):
+        return self.commands.keys()
+
+    def by_number(self, number):
+        return self.numbered[number] if 0 <= number < len(self.numbered) else None
+
+    def exact(self, cmd):
+        return list(self.folded.get(cmd.casefold(), []))
+
+    def prefixed(self, cmd):
+        # Names sharing a prefix are adjacent once sorted, so two binary searches find all of them
+        if self.sorted is None:
+            self.sorted = sorted(self.folded)
+        bisect = _lazy_import('bisect')
+        prefix = cmd.casefold()
+        start = bisect.bisect_left(self.sorted, prefix)
+        end = bisect.bisect_left(self.sorted, prefix + '\U0010ffff', start)
+        return [name for folded in self.sorted[start:end] for name in self.folded[folded]]
+
+    def suggest(self, cmd, limit=3):
+        '''Closest command names by edit distance, for "did you mean"'''
+        folded = cmd.casefold()
+        max_distance = max(1, min(3, len(folded) // 3))
+        ranked = []
+        for name_folded, names in self.folded.items():
+            distance = _edit_distance(folded, name_folded, max_distance)
+            if distance <= max_distance:
+                ranked.extend((distance, name) for name in names)
+        return [name for _, name in sorted(ranked)[:limit]]
+
+all_commands = None
+
+def _all_commands():
+    global all_commands
+    if all_commands is None:
+        start = _profile_start()
+        commands = dict(COMMANDS)
+        commands.update(NONINTERACTIVE)
+        all_commands = _CommandIndex(commands, COMMANDS)
+        _profile_phase('registry build', start)
+    return all_commands
+
+PLUGIN_ENTRY_POINT_GROUP = 'hey_helper.commands'
+PLUGIN_COMMAND_OPTIONS = ('command_name', 'noninteractive', 'needs_config')
+_PLUGINS = {'loaded': False}
+_PLUGIN_LOCK = _lazy_import('_thread').allocate_lock()
+
+def _plugin_manifest_path():
+    return os.path.join(_cache_dir(), 'plugin_manifest.json')
+
+def _scan_plugin_source(path, only=None):
+    '''Commands a plugin file declares with @command (or just `only`, a function name), read from its
+    source with ast so nothing is imported: {name: {function, doc, noninteractive, needs_config}}'''
+    ast = _lazy_import('ast')
+    with open(path, 'r') as stream:
+        tree = ast.parse(stream.read(), path)
+    found = {}
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        options = None
+        for decorator in node.decorator_list:
+            call = decorator if isinstance(decorator, ast.Call) else None
+            target = call.func if call else decorator
+            if (getattr(target, 'attr', None) or getattr(target, 'id', None)) != 'command':
+                continue
+            options = {}
+            for keyword in call.keywords if call else []:
+                if keyword.arg in PLUGIN_COMMAND_OPTIONS:
+                    try:
+                        options[keyword.arg] = ast.literal_eval(keyword.value)
+                    except ValueError:
+                        pass
+        if only is not None:
+            if node.name != only:
+                continue
+            options = options or {}
+        elif options is None:
+            continue
+        found[options.get('command_name') or node.name] = {
+            'function': node.name, 'doc': ast.get_docstring(node),
+            'noninteractive': bool(options.get('noninteractive', False)),
+            'needs_config': bool(options.get('needs_config', True)),
+        }
+    return found
+
+def _plugin_entry_points():
+    metadata = _lazy_import('importlib.metadata')
+    found = metadata.entry_points()
+    if hasattr(found, 'select'):
+        return list(found.select(group=PLUGIN_ENTRY_POINT_GROUP))
+    return list(found.get(PLUGIN_ENTRY_POINT_GROUP, []))
+
+def _module_source(module):
+    '''Where an importable module's source lives, without importing the module itself'''
+    try:
+        spec = _lazy_import('importlib.util').find_spec(module)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None or not spec.origin or not spec.origin.endswith('.py'):
+        return None
+    return spec.origin
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def _site_dirs_key():
+    '''Installing or removing a distribution touches its site dir, which is what can change entry points'''
+    return [[d, _mtime(d)] for d in sys.path if d and os.path.isdir(d)]
+
+def _build_plugin_manifest(plugins):
+    commands, sources = {}, {}
+    for plugin in plugins:
+        if plugin.endswith('.py') or os.sep in plugin:
+            path, module = os.path.realpath(plugin), None
+        else:
+            path, module = _module_source(plugin), plugin
+        if not path or not os.path.exists(path):
+            print('Plugin {} not found, skipping it.'.format(plugin))
+            continue
+        sources[path] = _stat_key(path)
+        for name, entry in _scan_plugin_source(path).items():
+            entry.update(path=path, module=module)
+            commands.setdefault(name, entry)
+
+    if CONFIG.get('plugin_entry_points', True):
+        for entry_point in _plugin_entry_points():
+            module, _, function = entry_point.value.partition(':')
+            path = _module_source(module)
+            entry = {'function': function, 'doc': None, 'noninteractive': False, 'needs_config': True}
+            if path:
+                sources[path] = _stat_key(path)
+                scanned = _scan_plugin_source(path, only=function)
+                entry.update(next(iter(scanned.values()), {}))
+            entry.update(path=None, module=module)
+            commands.setdefault(entry_point.name, entry)
+
+    return {'plugins': plugins, 'sources': sources, 'site_dirs': _site_dirs_key(), 'commands': commands}
+
+def _read_plugin_manifest(plugins):
+    '''The cached manifest, if nothing it was built from has changed since'''
+    manifest = _read_json(_plugin_manifest_path(), None)
+    if not isinstance(manifest, dict) or manifest.get('plugins') != plugins:
+        return None
+    if CONFIG.get('plugin_entry_points', True) and manifest.get('site_dirs') != _site_dirs_key():
+        return None
+    for path, key in manifest.get('sources', {}).items():
+        if _stat_key(path) != key:
+            return None
+    return manifest
+
+def _plugin_manifest(refresh=False):
+    plugins = [str(p) for p in CONFIG.get('plugins') or []]
+    manifest = None if refresh else _read_plugin_manifest(plugins)
+    if manifest is None:
+        manifest = _build_plugin_manifest(plugins)
+        _write_json(_plugin_manifest_path(), manifest)
+    return manifest
+
+class _PluginCommand:
+    '''Stands in for a plugin command from the manifest; the plugin module is only imported when it runs'''
+    def __init__(self, name, entry):
+        self.name = name
+        self.entry = entry
+        self.__doc__ = entry.get('doc')
+
+    def __call__(self):
+        # Plugins import `command` and friends from hey_helpers.hey_helpers; make that this module
+        # even when hey was run as a script
+        sys.modules.setdefault('hey_helpers.hey_helpers', sys.modules[__name__])
+        importlib = _lazy_import('importlib')
+        if self.entry['module']:
+            module = importlib.import_module(self.entry['module'])
+        else:
+            module_name = 'hey_plugin_' + os.path.splitext(os.path.basename(self.entry['path']))[0]
+            module = sys.modules.get(module_name)
+            if module is None:
+                util = _lazy_import('importlib.util')
+                spec = util.spec_from_file_location(module_name, self.entry['path'])
+                module = util.module_from_spec(spec)
+                sys.modules[module_name] = module
+                spec.loader.exec_module(module)
+        return getattr(module, self.entry['function'])()
+
+def _load_plugins():
+    '''Register the commands of hey.yml `plugins` (files or modules) and installed hey_helper.commands
+    entry points, from the manifest cached under the config root'''
+    if _PLUGINS['loaded']:
+        return
+    with _PLUGIN_LOCK:
+        if _PLUGINS['loaded']:
+            return
+        for name, entry in _plugin_manifest()['commands'].items():
+            if name in COMMANDS or name in NONINTERACTIVE:
+                continue
+            command(_PluginCommand(name, entry), command_name=name,
+                    noninteractive=entry['noninteractive'], needs_config=entry['needs_config'])
+        # Set last, so a batch item on another thread never sees a half registered set
+        _PLUGINS['loaded'] = True
+
+@command(noninteractive=True)
+def plugins():
+    """Lists plugin commands. `hey plugins refresh` rebuilds the manifest"""
+    manifest = _plugin_manifest(refresh=_args()[:1] == ['refresh'])
+    if not manifest['commands']:
+        print('No plugin commands. List plugin files or modules under `plugins` in hey.yml.')
+    for name, entry in sorted(manifest['commands'].items()):
+        target = '{}:{}'.format(entry['module'] or os.path.relpath(entry['path']), entry['function'])
+        print('{:<20} {:<40} {}'.format(name, target, (entry['doc'] or 'Needs docstring').split('\n')[0]))
+
+COMPLETION_SECTIONS = {'logs': 'services', 'dc': 'services', 'up': 'services', 'kubegettags': 'images'}
+
+COMPLETION_SCRIPTS = {
+    'bash': r'''
+_hey_index() {
+    local dir="$PWD" key src rest
+    until [ -f "$dir/hey.yml" ] || [ -f "$dir/hey.yaml" ]; do
+        [ -z "$dir" ] && return 1
+        dir="${dir%%/*}"
+    done
+    _hey_index="${dir:-/}/.hey/completion"
+    if [ ! -f "$_hey_index" ]; then
+        (cd "${dir:-/}" && hey completion refresh >/dev/null 2>&1)
+        return
+    fi
+    read -r key rest < "$_hey_index"
+    for src in $rest; do
+        if [ "$src" -nt "$_hey_index" ]; then
+            (cd "${dir:-/}" && hey completion refresh >/dev/null 2>&1 &)
+            break
+        fi
+    done
+}
 
-all_commands = dict(COMMANDS)
-all_commands.update(NONINTERACTIVE)
+_hey() {
+    local section key words
+    COMPREPLY=()
+    _hey_index || return
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        section=commands
+    else
+        case "${COMP_WORDS[1]}" in
+            %(bash_cases)s
+            *) return ;;
+        esac
+    fi
+    while read -r key words; do
+        if [ "$key" = "$section" ]; then
+            COMPREPLY=($(compgen -W "$words" -- "${COMP_WORDS[COMP_CWORD]}"))
+            return
+        fi
+    done < "$_hey_index"
+}
 
-def entrypoint():
+complete -F _hey hey
+''',
+    'zsh': r'''
+_hey() {
+    local dir=$PWD index key rest src section
+    until [[ -f $dir/hey.yml || -f $dir/hey.yaml ]]; do
+        [[ $dir == / ]] && return 1
+        dir=${dir:h}
+    done
+    index=$dir/.hey/completion
+    if [[ ! -f $index ]]; then
+        (cd $dir && hey completion refresh >/dev/null 2>&1)
+    else
+        read -r key rest < $index
+        for src in ${=rest}; do
+            if [[ $src -nt $index ]]; then
+                (cd $dir && hey completion refresh >/dev/null 2>&1 &)
+                break
+            fi
+        done
+    fi
+    if (( CURRENT == 2 )); then
+        section=commands
+    else
+        case $words[2] in
+            %(zsh_cases)s
+            *) return 1 ;;
+        esac
+    fi
+    while read -r key rest; do
+        [[ $key == $section ]] && compadd -- ${=rest}
+    done < $index
+}
+
+compdef _hey hey
+''',
+    'fish': r'''
+function __hey_words
+    set -l dir $PWD
+    while not test -f $dir/hey.yml -o -f $dir/hey.yaml
+        test -z "$dir"; and return 1
+        set dir (string replace -r '/[^/]*$' '' -- $dir)
+    end
+    test -z "$dir"; and set dir /
+    set -l index $dir/.hey/completion
+    if not test -f $index
+        command sh -c 'cd "$1" && hey completion refresh' sh $dir >/dev/null 2>&1
+    else
+        read -l key rest < $index
+        for src in (string split ' ' -- $rest)
+            if command test $src -nt $index
+                command sh -c 'cd "$1" && hey completion refresh' sh $dir >/dev/null 2>&1 &
+                break
+            end
+        end
+    end
+    while read -l key rest
+        test "$key" = $argv[1]; and string split ' ' -- $rest
+    end < $index
+end
+
+complete -c hey -f
+complete -c hey -n __fish_use_subcommand -a '(__hey_words commands)'
+%(fish_cases)s
+''',
+}
+
+def _completion_index_path():
+    return os.path.join(_cache_dir(), 'completion')
+
+def _completion_script(shell):
+    '''The completion script for a shell. It only reads the index; hey is run just to refresh a stale one'''
+    sections = {}
+    for name, section in COMPLETION_SECTIONS.items():
+        sections.setdefault(section, []).append(name)
+    return COMPLETION_SCRIPTS[shell].lstrip('\n') % {
+        'bash_cases': '\n            '.join('{}) section={} ;;'.format('|'.join(names), section)
+                                          for section, names in sections.items()),
+        'zsh_cases': '\n            '.join('{}) section={} ;;'.format('|'.join(names), section)
+                                         for section, names in sections.items()),
+        'fish_cases': '\n'.join("complete -c hey -n '__fish_seen_subcommand_from {}' -a '(__hey_words {})'".format(
+            ' '.join(names), section) for section, names in sections.items()),
+    }
+
+def _write_completion_index():
+    '''Write the words completion offers, one section per line, after a line of the files they came from.
+    The compose model and plugin manifest are cached already, so only what changed gets re-read.'''
+    _load_plugins()
+    compose_files = [os.path.realpath(f) for f in _get_compose_files()]
+    services = _compose_model().get('services') or {}
+    images = set(spec['name'] for spec in _image_specs()) | set(_read_tag_cache())
+    sources = [os.path.join(WORKING_DIR, f) for f in CONFIG_FILENAMES] + compose_files
+    sources += [os.path.realpath(__file__), _tag_cache_path(), _plugin_manifest_path()]
+    lines = [
+        ['sources'] + [p for p in sources if os.path.exists(p)],
+        ['commands'] + sorted(_all_commands().keys()),
+        ['services'] + sorted(services),
+        ['images'] + sorted(images),
+    ]
+    index_path = _completion_index_path()
+    # Completion splits on whitespace, so a word containing any can't be offered anyway
+    text = ''.join(' '.join(w for w in words if not set(w) & set(' \t\n')) + '\n' for words in lines)
+    _atomic_write(index_path, lambda stream: stream.write(text))
+    return index_path
+
+@command(noninteractive=True, needs_config=False)
+def completion():
+    """Prints a shell completion script: `hey completion bash|zsh|fish` (`refresh` rebuilds the index)"""
+    shell = _args()[0] if _args() else os.path.basename(os.environ.get('SHELL', 'bash'))
+    if shell == 'refresh':
+        _go_to_working_dir()
+        print('Completion index written to', _write_completion_index())
+    elif shell in COMPLETION_SCRIPTS:
+        print(_completion_script(shell), end='')
+    else:
+        print('There was a problem: no completion for {}, use one of {}'.format(shell, ', '.join(COMPLETION_SCRIPTS)))
+        sys.exit(1)
+
+def _split_batch(args):
+    '''`a x -- b -- c y` -> [['a', 'x'], ['b'], ['c', 'y']]'''
+    items, current = [], []
+    for arg in args:
+        if arg == '--':
+            items.append(current)
+            current = []
+        else:
+            current.append(arg)
+    return [item for item in items + [current] if item]
+
+def _run_batch_item(item):
+    '''Run `name args...` in this process; returns its exit code and how long it took instead of exiting'''
+    started = perf_counter()
+    try:
+        returncode = 0 if _command_match(item[0], _short_commands_enabled(item[0]), args=item[1:]) else 127
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+    return returncode, perf_counter() - started
+
+@command(noninteractive=True, needs_config=False)
+def run():
+    """Run several commands in one process: `hey run [--parallel] [--keep-going] cmd1 args -- cmd2 -- cmd3`"""
+    args = _args()
+    parallel = keep_going = False
+    while args and args[0] in ('--parallel', '--keep-going'):
+        if args.pop(0) == '--parallel':
+            parallel = True
+        else:
+            keep_going = True
+    items = _split_batch(args)
+    if not items:
+        print('There was a problem: nothing to run. Separate commands with --, e.g. `hey run up -- migrate`')
+        sys.exit(1)
+
+    results = {}
+    if parallel:
+        # Only for items that don't depend on each other; their output interleaves
+        futures = _lazy_import('concurrent.futures')
+        with futures.ThreadPoolExecutor(max_workers=CONFIG.get('batch_workers', 4)) as pool:
+            results = dict(enumerate(pool.map(_run_batch_item, items)))
+    else:
+        for i, item in enumerate(items):
+            results[i] = _run_batch_item(item)
+            if results[i][0] and not keep_going:
+                break
+
+    width = max(len(' '.join(item)) for item in items)
+    print('\n{:<{}}  {:>7}  {:>8}'.format('command', width, 'exit', 'time'))
+    for i, item in enumerate(items):
+        returncode, seconds = results.get(i, ('skipped', None))
+        print('{:<{}}  {:>7}  {:>8}'.format(' '.join(item), width, returncode, _format_seconds(seconds)))
+    if any(returncode for returncode, _ in results.values()) or len(results) < len(items):
+        sys.exit(1)
+
+@command(noninteractive=True, needs_config=False)
+def repl():
+    """A `hey>` prompt that keeps the config, compose model, pod names and tags loaded between commands"""
+    try:
+        readline = _lazy_import('readline')
+    except ImportError:
+        readline = None
+    history_path = os.path.join(_user_cache_dir(), 'repl_history')
+    if readline:
+        names = lambda text: sorted(n for n in _all_commands().keys() if n.startswith(text))
+        readline.set_completer(lambda text, state: (names(text) + [None])[state])
+        readline.parse_and_bind('tab: complete')
+        try:
+            readline.read_history_file(history_path)
+        except OSError:
+            pass
+    print('Type a command with its arguments; `exit` or Ctrl-D to leave.')
+    while True:
+        try:
+            line = input('hey> ')
+        except EOFError:
+            print()
+            break
+        except KeyboardInterrupt:
+            print()
+            continue
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print('There was a problem: {}'.format(e))
+            continue
+        if not words:
+            continue
+        if words[0] in ('exit', 'quit'):
+            break
+        try:
+            returncode, seconds = _run_batch_item(words)
+        except KeyboardInterrupt:
+            print('\nInterrupted')
+            continue
+        if returncode:
+            print('[exit {} after {}]'.format(returncode, _format_seconds(seconds)))
+    if readline:
+        try:
+            os.makedirs(os.path.dirname(history_path), exist_ok=True)
+            readline.set_history_length(1000)
+            readline.write_history_file(history_path)
+        except OSError:
+            pass
+
+def _short_commands_enabled(cmd):
+    '''An exact command name never needs the config, so only look up short_commands otherwise'''
+    index = _all_commands()
+    if index.exact(cmd) or cmd.isdigit() and index.by_number(int(cmd)):
+        return False
+    _go_to_working_dir()
+    # Not a built-in, so it may be a plugin command
+    _load_plugins()
+    return CONFIG.get('short_commands', False)
+
+def _process_age():
+    '''Seconds since the interpreter process started (Linux only, ~10ms resolution)'''
+    try:
+        with open('/proc/self/stat', 'r') as stream:
+            start_ticks = int(stream.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as stream:
+            uptime = float(stream.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def _print_startup_profile():
+    ms = lambda seconds: '{:8.2f} ms'.format(seconds * 1000)
+    out = sys.stderr
+    print('\nStartup profile', file=out)
+    print('  {:<24}{}'.format('module import', ms(_MODULE_LOADED - _MODULE_START)), file=out)
+    startup = _MODULE_LOADED - _MODULE_START
+    for phase in ['config walk', 'yaml parse', 'registry build']:
+        seconds = _PROFILE['phases'].get(phase, 0)
+        startup += seconds
+        print('  {:<24}{}'.format(phase, ms(seconds)), file=out)
+    for name, seconds in _PROFILE['imports']:
+        print('  {:<24}{}'.format('import ' + name, ms(seconds)), file=out)
+    startup += _PROFILE['import_total']
+    print('  {:<24}{}'.format('startup total', ms(startup)), file=out)
+    print('  {:<24}{}'.format('dispatch', ms(_PROFILE['phases'].get('dispatch', 0))), file=out)
+    age = _process_age()
+    if age is not None:
+        print('  {:<24}{}'.format('process wall time', ms(age)), file=out)
+    budget = CONFIG.get('startup_budget_ms', 50)
+    if startup * 1000 > budget:
+        print('  Over the {} ms startup budget!'.format(budget), file=out)
+
+# Directories --each never looks inside when searching for project roots
+EACH_SKIP_DIRS = ['node_modules', '__pycache__', 'venv', 'site-packages']
+
+def _each_roots(spec, max_depth=4):
+    '''Project roots for --each: the directories listed in @FILE, or every directory under spec holding
+    a hey.yml (not looking further down once one is found)'''
+    if spec.startswith('@'):
+        with open(os.path.expanduser(spec[1:]), 'r') as stream:
+            entries = [line.strip() for line in stream if line.strip() and not line.startswith('#')]
+        return [os.path.realpath(os.path.expanduser(e)) for e in entries]
+    base = os.path.realpath(os.path.expanduser(spec))
+    roots = []
+    for dirpath, dirnames, filenames in os.walk(base):
+        if any(f in CONFIG_FILENAMES for f in filenames):
+            roots.append(dirpath)
+            dirnames[:] = []
+            continue
+        depth = 0 if dirpath == base else os.path.relpath(dirpath, base).count(os.sep) + 1
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d not in EACH_SKIP_DIRS
+                             and depth < max_depth)
+    return roots
+
+def _run_each(argv):
+    '''`hey --each[=DIR|=@FILE] [--parallel=N] <command> [args]`: run the command in every project root.
+    Each root gets its own hey process, so config, compose model and working directory stay separate.'''
+    spec = argv[0].partition('=')[2] or os.curdir
+    args = argv[1:]
+    parallel = 4
+    if args and args[0].startswith('--parallel'):
+        option = args.pop(0)
+        parallel = int(option.partition('=')[2] or args.pop(0))
+    if not args:
+        print('There was a problem: no command given, e.g. `hey --each=~/src migrate`')
+        sys.exit(1)
+    roots = _each_roots(spec)
+    if not roots:
+        print('There was a problem: no {} found under {}'.format(' or '.join(CONFIG_FILENAMES), spec))
+        sys.exit(1)
+    common = os.path.commonpath(roots) if len(roots) > 1 else os.path.dirname(roots[0])
+    names = {os.path.relpath(root, common): root for root in roots}
+    print('Running `{}` in {} root(s), {} at a time'.format(' '.join(args), len(roots), parallel))
+    hey = [sys.executable, os.path.realpath(__file__)]
+    _fan_out({name: hey + args for name in names}, parallel, label='root', cwds=names)
+
+def _dispatch():
     if len(sys.argv) < 2:
         welcome()
     else:
-        _command_match(sys.argv[1], CONFIG.get('short_commands', False))
+        _command_match(sys.argv[1], _short_commands_enabled(sys.argv[1]))
+
+def entrypoint():
+    global _PROFILE
+    if len(sys.argv) > 1 and sys.argv[1].split('=')[0] == '--each':
+        _run_each(sys.argv[1:])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--profile-startup':
+        _PROFILE = {'phases': {}, 'imports': [], 'import_total': 0}
+        # Commands read their arguments from sys.argv[2:] (see _args)
+        del sys.argv[1]
+        try:
+            _dispatch()
+        finally:
+            _print_startup_profile()
+    else:
+        _dispatch()
+
+_MODULE_LOADED = perf_counter()
 
 if __name__ == '__main__':
     entrypoint()
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+PROJECT = {
+    'conftest.py': '',
+    'app/__init__.py': '',
+    'app/models.py': 'import json\n',
+    'app/views.py': 'from .models import Item\n',
+    'app/tests/__init__.py': '',
+    'app/tests/test_views.py': 'from app import views\n',
+    'app/tests/test_models.py': 'from app.models import Item\n',
+    'billing/__init__.py': '',
+    'billing/invoice.py': 'import decimal\n',
+    'billing/test_invoice.py': 'from billing.invoice import total\n',
+}
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    # The import index is cached under the project's .hey folder
+    monkeypatch.setattr(hey, 'WORKING_DIR', str(tmp_path))
+    for path, text in PROJECT.items():
+        full = tmp_path / 'django' / path
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_text(text)
+    return str(tmp_path / 'django')
+
+
+def test_changed_module_selects_tests_that_import_it_indirectly(root):
+    assert hey._affected_tests(root, [os.path.join('app', 'models.py')]) == \
+        [os.path.join('app', 'tests', 'test_models.py'), os.path.join('app', 'tests', 'test_views.py')]
+
+
+def test_changed_test_file_selects_itself(root):
+    test_file = os.path.join('billing', 'test_invoice.py')
+    assert hey._affected_tests(root, [test_file]) == [test_file]
+
+
+def test_unrelated_change_selects_nothing(root):
+    assert hey._affected_tests(root, ['README.md']) == []
+
+
+def test_global_file_means_everything(root):
+    assert hey._affected_tests(root, ['conftest.py']) is None
+
+
+def test_import_index_is_reused_until_a_file_changes(root):
+    first = hey._import_index(root)
+    assert os.path.isfile(os.path.join(os.path.dirname(root), '.hey', 'test_deps.json'))
+    with open(os.path.join(root, 'billing', 'invoice.py'), 'a') as stream:
+        stream.write('from app import models\n')
+    second = hey._import_index(root)
+    assert 'app.models' not in first[os.path.join('billing', 'invoice.py')]
+    assert 'app.models' in second[os.path.join('billing', 'invoice.py')]
+
+
+def test_shards_balance_recorded_durations():
+    durations = {'a.py': 10.0, 'b.py': 6.0, 'c.py': 4.0, 'd.py': 1.0}
+    shards = hey._shard_tests(list(durations), durations, 2)
+    assert sorted(seconds for seconds, _ in shards) == [10.0, 11.0]
+    assert sorted(path for _, files in shards for path in files) == sorted(durations)
+
+
+def test_unknown_files_count_as_the_average():
+    shards = hey._shard_tests(['known.py', 'new1.py', 'new2.py'], {'known.py': 2.0}, 3)
+    assert [seconds for seconds, _ in shards] == [2.0, 2.0, 2.0]
+
+
+def test_no_more_shards_than_files():
+    assert len(hey._shard_tests(['only.py'], {}, 4)) == 1
@@ -0,0 +1,36 @@
+import threading
+from time import sleep
+
+from hey_helpers import hey_helpers as hey
+
+
+def test_parallel_items_all_see_the_loaded_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(hey, 'WORKING_DIR', None)
+    monkeypatch.setattr(hey, 'CONFIG', {})
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hey, '_resolve_config',
+                        lambda start_dir: {'root': str(tmp_path), 'config': {'compose_files': ['dc.yml']}})
+    # Widen the window between finding the root and loading its config
+    monkeypatch.setattr(hey, 'print', lambda *args, **kwargs: sleep(0.2), raising=False)
+
+    seen = []
+    def item():
+        hey._go_to_working_dir()
+        seen.append(hey.CONFIG.get('compose_files'))
+    threads = [threading.Thread(target=item) for _ in range(4)]
+    threads[0].start()
+    sleep(0.1)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [['dc.yml']] * 4
+
+
+def test_welcome_survives_an_unbalanced_quote(monkeypatch, capsys):
+    answers = iter(['dc "ps', 'q'])
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+    monkeypatch.setattr(hey, '_go_to_working_dir', lambda: None)
+    monkeypatch.setattr(hey, '_load_plugins', lambda: None)
+    hey.welcome()
+    assert 'There was a problem: No closing quotation' in capsys.readouterr().out
@@ -0,0 +1,43 @@
+from hey_helpers import hey_helpers as hey
+
+
+def noop():
+    pass
+
+
+def index():
+    commands = {name: noop for name in ['restore', 'reset', 'kubeexec', 'kubelogs', 'Migrate', 'logs']}
+    return hey._CommandIndex(commands, ['restore', 'kubeexec', 'logs'])
+
+
+def test_exact_is_case_insensitive():
+    assert index().exact('migrate') == ['Migrate']
+    assert index().exact('migr') == []
+
+
+def test_prefixed_finds_every_name_sharing_the_prefix():
+    assert index().prefixed('kube') == ['kubeexec', 'kubelogs']
+    assert index().prefixed('res') == ['reset', 'restore']
+    assert index().prefixed('x') == []
+
+
+def test_numbers_follow_the_menu():
+    assert index().by_number(1) == 'kubeexec'
+    assert index().by_number(3) is None
+
+
+def test_suggest_ranks_by_edit_distance():
+    assert index().suggest('restor') == ['restore']
+    assert index().suggest('kubelog')[0] == 'kubelogs'
+    assert index().suggest('zzzzzzzz') == []
+
+
+def test_edit_distance_stops_past_the_limit():
+    assert hey._edit_distance('kitten', 'sitting', 5) == 3
+    assert hey._edit_distance('kitten', 'sitting', 2) == 3
+    assert hey._edit_distance('a', 'abcdef', 2) == 3
+
+
+def test_menu_descriptions_fit_on_one_line():
+    # welcome() prints each docstring as is, after the command's number
+    assert [name for name, func in hey.COMMANDS.items() if '\n' in (func.__doc__ or '')] == []
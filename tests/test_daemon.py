@@ -0,0 +1,59 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='the daemon needs unix sockets')
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    path = str(tmp_path / 'daemon.sock')
+    thread = threading.Thread(target=hey._daemon_serve, args=(path,), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if hey._daemon_request({'op': 'ping'}, path):
+            break
+        threading.Event().wait(0.02)
+    # The daemon is handed our stdin, which pytest replaces with something that has no fd
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    yield path
+    hey._daemon_request({'op': 'stop'}, path)
+    thread.join(5)
+    sys.stdin.close()
+
+
+def test_ping_reports_the_daemon(daemon):
+    status = hey._daemon_request({'op': 'ping'}, daemon)
+    assert status['pid'] == os.getpid()
+    assert os.stat(daemon).st_mode & 0o777 == 0o600
+
+
+def test_run_round_trip(daemon, monkeypatch, tmp_path):
+    monkeypatch.setenv('HEY_DAEMON_TEST', 'from the client')
+    monkeypatch.chdir(tmp_path)
+    command = ['sh', '-c', 'echo "$HEY_DAEMON_TEST in $(pwd)"; echo oops >&2; exit 3']
+    result = hey._daemon_run(hey._daemon_connect(daemon), command, capture_stdout=True, echo_stderr=False)
+    assert result.returncode == 3
+    assert result.stdout == 'from the client in {}\n'.format(os.path.realpath(str(tmp_path))).encode()
+    assert result.stderr == b'oops\n'
+
+
+def test_socket_of_another_user_is_ignored(daemon, monkeypatch):
+    # Only for the client side: the daemon in this process must still accept the stop request
+    with monkeypatch.context() as patched:
+        patched.setattr(hey, '_daemon_peer_uid', lambda sock, path: os.getuid() + 1)
+        assert hey._daemon_connect(daemon) is None
+
+
+def test_long_paths_fall_back_to_a_private_folder(tmp_path, monkeypatch):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setenv('HEY_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(hey, 'WORKING_DIR', str(tmp_path / ('deep' * 30)))
+    path = hey._daemon_socket_path()
+    assert os.path.dirname(path) == str(tmp_path / 'cache' / 'sockets')
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
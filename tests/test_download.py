@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+MB = 1 << 20
+
+
+class RecordingTransport(hey._LocalTransport):
+    '''A file:// transport that remembers every range it was asked for and can fail one of them'''
+    def __init__(self, directory, fail_at=None, checksum=None):
+        super().__init__(directory)
+        self.ranges = []
+        self.fail_at = fail_at
+        self.remote_checksum = checksum
+
+    def open_range(self, name, offset, length=None):
+        self.ranges.append((offset, length))
+        if offset == self.fail_at:
+            raise OSError('connection reset')
+        return super().open_range(name, offset, length)
+
+    def checksum(self, name):
+        return self.remote_checksum or super().checksum(name)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    '''A 20 MB backup in a folder standing in for the backup host'''
+    folder = tmp_path / 'remote'
+    folder.mkdir()
+    data = os.urandom(20 * MB)
+    (folder / 'backup.tar.gz').write_bytes(data)
+    return str(folder), data
+
+
+def test_ranges_are_split_across_connections(remote, tmp_path):
+    folder, data = remote
+    transport = RecordingTransport(folder)
+    dest = str(tmp_path / 'backup.tar.gz')
+    digest = hey._download(transport, 'backup.tar.gz', len(data), dest, connections=4)
+    # 8 MB is the smallest range worth its own connection
+    assert sorted(transport.ranges) == [(0, 10 * MB), (10 * MB, 10 * MB)]
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert open(dest, 'rb').read() == data
+    assert not os.path.exists(dest + '.part') and not os.path.exists(dest + '.part.json')
+
+
+def test_resumes_from_the_saved_state(remote, tmp_path):
+    folder, data = remote
+    dest = str(tmp_path / 'backup.tar.gz')
+    with open(dest + '.part', 'wb') as stream:
+        stream.write(data[:3 * MB])
+        stream.truncate(len(data))
+    with open(dest + '.part.json', 'w') as stream:
+        json.dump({'name': 'backup.tar.gz', 'size': len(data),
+                   'chunks': [[0, 10 * MB, 3 * MB], [10 * MB, 20 * MB, 0]]}, stream)
+    transport = RecordingTransport(folder)
+    hey._download(transport, 'backup.tar.gz', len(data), dest)
+    assert sorted(transport.ranges) == [(3 * MB, 7 * MB), (10 * MB, 10 * MB)]
+    assert open(dest, 'rb').read() == data
+
+
+def test_checksum_mismatch_removes_the_download(remote, tmp_path):
+    folder, data = remote
+    dest = str(tmp_path / 'backup.tar.gz')
+    with pytest.raises(SystemExit):
+        hey._download(RecordingTransport(folder, checksum='0' * 64), 'backup.tar.gz', len(data), dest)
+    assert os.listdir(str(tmp_path)) == ['remote']
+
+
+@pytest.mark.parametrize('verify', [False, True])
+def test_failed_range_is_never_renamed_into_place(remote, tmp_path, verify):
+    folder, data = remote
+    dest = str(tmp_path / 'backup.tar.gz')
+    # Every attempt at the second range fails
+    transport = RecordingTransport(folder, fail_at=10 * MB)
+    with pytest.raises(SystemExit):
+        hey._download(transport, 'backup.tar.gz', len(data), dest, verify=verify)
+    assert not os.path.exists(dest)
+    with open(dest + '.part.json') as stream:
+        chunks = json.load(stream)['chunks']
+    # The finished range is kept, so the next run only fetches the rest
+    assert sorted(c[2] for c in chunks) == [0, 10 * MB]
+
+    hey._download(RecordingTransport(folder), 'backup.tar.gz', len(data), dest, verify=verify)
+    assert open(dest, 'rb').read() == data
+
+
+def test_ssh_listing_skips_checksum_files(remote, monkeypatch):
+    folder, data = remote
+    with open(os.path.join(folder, 'backup.tar.gz.sha256'), 'w') as stream:
+        stream.write(hashlib.sha256(data).hexdigest() + '\n')
+    transport = hey._SSHTransport('backups.example', folder)
+    # Run the remote command locally instead of over ssh
+    monkeypatch.setattr(transport, '_ssh', lambda remote_command: ['sh', '-c', remote_command])
+    assert transport.latest() == ('backup.tar.gz', len(data))
+    assert transport.checksum('backup.tar.gz') == hashlib.sha256(data).hexdigest()
+
+
+def test_store_is_only_locked_around_the_index(remote, tmp_path, monkeypatch):
+    fcntl = pytest.importorskip('fcntl')
+    folder, data = remote
+    store_path = str(tmp_path / 'store')
+    lock_free = []
+    class CheckingTransport(RecordingTransport):
+        def open_range(self, name, offset, length=None):
+            fd = os.open(os.path.join(store_path, 'lock'), os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                lock_free.append(True)
+            except BlockingIOError:
+                lock_free.append(False)
+            finally:
+                os.close(fd)
+            return super().open_range(name, offset, length)
+    project = tmp_path / 'project'
+    project.mkdir()
+    monkeypatch.setattr(hey, 'CONFIG', {'backup_store': store_path})
+    monkeypatch.setattr(hey, '_go_to_working_dir', lambda: str(project))
+    monkeypatch.setattr(hey, '_backup_transport', lambda: CheckingTransport(folder))
+    assert hey.getbackup() == 'backup.tar.gz'
+    assert lock_free == [True, True]
+    assert open(str(project / 'backup.tar.gz'), 'rb').read() == data
+    # Other members of the group can add to the store too
+    assert os.stat(store_path).st_mode & 0o2775 == 0o2775
+    assert os.stat(os.path.join(store_path, 'objects')).st_mode & 0o2775 == 0o2775
@@ -0,0 +1,27 @@
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+
+@pytest.fixture
+def images(monkeypatch):
+    monkeypatch.setattr(hey, 'TASKS', dict(hey.TASKS))
+    def configure(*specs):
+        monkeypatch.setattr(hey, 'CONFIG', {'images': list(specs)})
+    return configure
+
+
+def test_depends_on_names_images_or_tasks(images):
+    images({'name': 'gcr.io/habitdb/base', 'tag': 'latest'},
+           {'name': 'gcr.io/habitdb/www', 'tag': 'latest', 'depends_on': ['base', 'client-secret']})
+    hey._image_tasks()
+    assert hey.TASKS['build:www']['deps'] == ['build:base', 'client-secret']
+    assert hey._task_order(['build:www']) == ['build:base', 'credentials', 'client-secret', 'build:www']
+
+
+def test_unknown_dependency_is_a_readable_error(images, capsys):
+    images({'name': 'gcr.io/habitdb/www', 'tag': 'latest', 'depends_on': ['bsae']})
+    with pytest.raises(SystemExit) as exit_info:
+        hey._image_tasks()
+    assert exit_info.value.code == 1
+    assert 'There was a problem: unknown dependency bsae of gcr.io/habitdb/www' in capsys.readouterr().out
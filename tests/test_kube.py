@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+PODS = {'items': [
+    {'metadata': {'name': 'www-pending'}, 'status': {'phase': 'Pending'}},
+    {'metadata': {'name': 'www-a'}, 'status': {'phase': 'Running'}},
+    {'metadata': {'name': 'www-leaving', 'deletionTimestamp': '2026-10-17T17:00:00Z'}, 'status': {'phase': 'Running'}},
+    {'metadata': {'name': 'www-b'}, 'status': {'phase': 'Running'}},
+]}
+
+# Answers `get pods -o json` from PODS; `exec <pod> ...` prints a short and a 100 KB line, and fails on www-b
+KUBECTL = '''#!{python}
+import sys
+args = sys.argv[1:]
+if args[:2] == ['get', 'pods']:
+    print({pods!r})
+elif args[0] == 'exec':
+    print('hello from', args[1])
+    print('x' * 100000)
+    sys.exit(3 if args[1] == 'www-b' else 0)
+'''
+
+
+@pytest.fixture
+def kubectl(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'kubectl').write_text(KUBECTL.format(python=sys.executable, pods=json.dumps(PODS)))
+    (bin_dir / 'kubectl').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep, os.environ['PATH']))
+    monkeypatch.setattr(hey, '_PODS', {})
+
+
+def test_only_running_pods_are_picked(kubectl):
+    assert hey._kube_pods('name=www', running_only=True) == ['www-a', 'www-b']
+    assert hey._kube_pods('name=www')[:2] == ['www-a', 'www-b']
+
+
+def test_exec_fans_out_with_prefixes_and_reports_the_failing_pod(kubectl, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['hey', 'kubeexec', '--all', '--parallel', '2', 'django', 'whoami'])
+    with pytest.raises(SystemExit) as exit_info:
+        hey.kubeexec()
+    assert exit_info.value.code == 1
+    lines = capsys.readouterr().out.splitlines()
+    for pod in ('www-a', 'www-b'):
+        assert '{:<5} | hello from {}'.format(pod, pod) in lines
+        assert '{:<5} | {}'.format(pod, 'x' * 100000) in lines
+    summary = [line.split() for line in lines[lines.index('pod    exit      time'):]]
+    assert [row[:2] for row in summary[1:3]] == [['www-a', '0'], ['www-b', '3']]
+    assert lines[-1] == '1/2 succeeded'
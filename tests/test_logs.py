@@ -0,0 +1,80 @@
+import asyncio
+import io
+import sys
+
+from hey_helpers import hey_helpers as hey
+
+
+def test_filter_grep_and_level():
+    log_filter = hey._LogFilter(['timeout', 'refused'], 'warning')
+    assert log_filter('ERROR connection refused')
+    assert log_filter('WARNING request timeout after 30s')
+    assert not log_filter('DEBUG connection refused')
+    assert not log_filter('ERROR disk full')
+
+
+def test_filter_without_level_counts_as_info():
+    assert hey._LogFilter(level='INFO')('GET /health 200')
+    assert not hey._LogFilter(level='WARN')('GET /health 200')
+    assert hey._LogFilter()('anything at all')
+
+
+def test_sort_key_pads_docker_trimmed_fractions():
+    assert hey._log_sort_key('2026-10-17T17:00:00.5Z') > hey._log_sort_key('2026-10-17T17:00:00.123456789Z')
+    assert hey._log_sort_key('2026-10-17T17:00:01Z') > hey._log_sort_key('2026-10-17T17:00:00.999Z')
+
+
+def test_merger_orders_streams_by_timestamp():
+    merger = hey._LogMerger(window=0.25)
+    merger.push('web', '2026-10-17T17:00:00.300Z third', 0.0)
+    merger.push('worker', '2026-10-17T17:00:00.100Z first', 0.0)
+    merger.push('web', '2026-10-17T17:00:00.2Z second', 0.0)
+    assert [(source, message) for _, source, message in merger.pop_ready()] == \
+        [('worker', 'first'), ('web', 'second'), ('web', 'third')]
+
+
+def test_merger_holds_lines_back_for_the_window():
+    merger = hey._LogMerger(window=0.25)
+    merger.push('web', '2026-10-17T17:00:00.200Z late arrival', 1.0)
+    assert merger.pop_ready(now=1.1) == []
+    merger.push('worker', '2026-10-17T17:00:00.100Z earlier', 1.1)
+    # The earlier line turned up within the window, so it still comes out first
+    assert [message for _, _, message in merger.pop_ready(now=1.4)] == ['earlier', 'late arrival']
+    assert merger.pop_ready() == []
+
+
+def test_untimestamped_line_follows_its_stream():
+    merger = hey._LogMerger()
+    merger.push('web', '2026-10-17T17:00:00.100Z Traceback (most recent call last):', 0.0)
+    merger.push('worker', '2026-10-17T17:00:00.150Z unrelated', 0.0)
+    merger.push('web', '  File "app.py", line 1', 0.0)
+    assert [message for _, _, message in merger.pop_ready()] == \
+        ['Traceback (most recent call last):', '  File "app.py", line 1', 'unrelated']
+
+
+def test_parse_log_line_sources():
+    assert hey._parse_log_line(None, b'[pod/www-5d8f/django] 2026-10-17T17:00:00Z hello\n') == \
+        ('www-5d8f/django', '2026-10-17T17:00:00Z hello')
+    assert hey._parse_log_line('web', b'web_1  | 2026-10-17T17:00:00Z hello\r\n') == \
+        ('web', '2026-10-17T17:00:00Z hello')
+
+
+def test_aggregator_survives_a_missing_tool_and_long_lines():
+    out = io.BytesIO()
+    long_line = 'x' * 100000
+    sources = [('web', [sys.executable, '-c', 'print("2026-10-17T17:00:00Z {}")'.format(long_line)]),
+               (None, ['hey-no-such-kubectl', 'logs'])]
+    failures = asyncio.run(hey._aggregate_logs(sources, hey._LogFilter(), hey._LogMerger(0.05), out))
+    assert failures == ['hey-no-such-kubectl']
+    assert out.getvalue().decode().rstrip('\n').endswith('| ' + long_line)
+
+
+def test_read_lines_splits_chunks_on_newlines():
+    async def lines(data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return [line async for line in hey._read_lines(reader)]
+    big = b'y' * 200000
+    assert asyncio.run(lines(b'a\nb\n' + big + b'\ntail')) == [b'a\n', b'b\n', big + b'\n', b'tail']
+    assert asyncio.run(lines(b'')) == []
@@ -0,0 +1,65 @@
+import socket
+import threading
+from time import perf_counter, sleep
+
+from hey_helpers import hey_helpers as hey
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def serve(port, reply, delay=0.0, connections=1):
+    '''Start listening on port after `delay` seconds and answer each connection with `reply` (b'' hangs up)'''
+    listening = threading.Event()
+    def run():
+        sleep(delay)
+        with socket.socket() as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('127.0.0.1', port))
+            server.listen(4)
+            listening.set()
+            for _ in range(connections):
+                conn, _ = server.accept()
+                with conn:
+                    conn.recv(len(hey.PG_SSL_REQUEST))
+                    if reply:
+                        conn.sendall(reply)
+    threading.Thread(target=run, daemon=True).start()
+    return listening
+
+
+def test_waits_until_postgres_answers():
+    port = free_port()
+    serve(port, b'N', delay=0.3)
+    started = perf_counter()
+    probe = hey._tcp_probe('127.0.0.1', port, payload=hey.PG_SSL_REQUEST)
+    assert hey._wait_until_ready([('tcp', probe)], timeout=5, max_delay=0.1)
+    assert 0.3 <= perf_counter() - started < 2
+
+
+def test_gives_up_at_the_timeout():
+    started = perf_counter()
+    probe = hey._tcp_probe('127.0.0.1', free_port(), payload=hey.PG_SSL_REQUEST)
+    assert not hey._wait_until_ready([('tcp', probe)], timeout=0.3, max_delay=0.1)
+    assert perf_counter() - started < 1
+
+
+def test_proxy_that_hangs_up_is_not_ready():
+    port = free_port()
+    serve(port, b'').wait(5)
+    assert not hey._tcp_probe('127.0.0.1', port, payload=hey.PG_SSL_REQUEST)()
+
+
+def test_probes_run_in_order_and_pass_once():
+    calls = []
+    def probe(name, ready_after):
+        def run():
+            calls.append(name)
+            return calls.count(name) >= ready_after
+        return run
+    assert hey._wait_until_ready([('first', probe('first', 2)), ('second', probe('second', 1))],
+                                 timeout=5, initial_delay=0.01)
+    assert calls == ['first', 'first', 'second']
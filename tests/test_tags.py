@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from hey_helpers import hey_helpers as hey
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'list_tags')
+
+
+def recorded(name):
+    '''Output of `gcloud container images list-tags IMAGE --limit=1 --format=value(tags[])`'''
+    with open(os.path.join(FIXTURES, name), 'r') as stream:
+        return stream.read()
+
+
+@pytest.mark.parametrize('fixture, expected', [
+    ('habitdb-www.txt', [1, 4, 12]),
+    ('multi-digit.txt', [2, 10, 0]),
+    ('quoted.txt', [0, 3, 7]),
+    ('latest-only.txt', []),
+    ('no-images.txt', []),
+])
+def test_parse_tag_array(fixture, expected):
+    assert hey._parse_tag_array(recorded(fixture)) == expected
+
+
+def test_trailing_newline_does_not_add_a_tag():
+    assert hey._parse_tag_array('v1.2.3\n') == hey._parse_tag_array('v1.2.3') == [1, 2, 3]
+
+
+def test_components_compare_as_numbers():
+    assert hey._parse_tag_array('v1.9.9;v1.10.0') == [1, 10, 0]
+
+
+def _looked_up(monkeypatch, image_name, output):
+    monkeypatch.setattr(hey, '_TAGS', {})
+    monkeypatch.setattr(hey, '_run_command', lambda command, **kwargs: type('Result', (), {'stdout': output.encode()}))
+    return hey._kubegetlatesttagarray(image_name)
+
+
+def test_next_tag_follows_the_latest_version(monkeypatch):
+    assert _looked_up(monkeypatch, 'gcr.io/habitdb/habitdb-www', recorded('habitdb-www.txt')) == [1, 4, 12]
+    assert hey._kubegetnexttag('gcr.io/habitdb/habitdb-www') == 'gcr.io/habitdb/habitdb-www:v1.4.13'
+
+
+def test_image_without_versions_starts_at_0_0_1(monkeypatch):
+    assert _looked_up(monkeypatch, 'gcr.io/habitdb/new', recorded('latest-only.txt')) == []
+    assert hey._kubegetnexttag('gcr.io/habitdb/new') == 'gcr.io/habitdb/new:v0.0.1'